@@ -109,17 +109,19 @@ class Client:
         '''
         while self.running:
             try:
-                #Extracts the message type, length, data and server address from the received message
-                message_type, message_length, message_data, server_address = util.handle_message(self.sock)
-                #Checks if message type is response_users_list. If so, turns the data into a string seperated by spaces and prints it
+                #Extracts the message and server address from the received packet
+                message, server_address = util.handle_message(self.sock)
+                if message is None:
+                    continue
+                message_type = message.type
+                #Checks if message type is response_users_list. If so, prints the space separated users in the data
                 if message_type == 'response_users_list':
-                    users= ' '.join(message_data)
+                    users = message.body
                     print("list:", users)
-                #Checks if message type is forward_message. If so, it extracts the sender (first word of data) and message (rest of data turned into a string seperated by spaces) from the data and prints it
+                #Checks if message type is forward_message. If so, it extracts the sender (first word of data) and message (rest of data) from the data and prints it
                 elif message_type == 'forward_message':
-                    sender = message_data[0]
-                    message = ' '.join(message_data[1:])
-                    print(f"msg: {sender}: {message}")
+                    sender, _, content = message.body.partition(' ')
+                    print(f"msg: {sender}: {content}")
                 #Checks if message type is err_server_full. If so, it prints an error message and quits the server
                 elif message_type == 'err_server_full':
                     print('disconnected: server full')
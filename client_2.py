@@ -4,14 +4,16 @@ This module defines the behaviour of a client in your Chat Application
 import sys
 import getopt
 import socket
+import select
 import random
-from threading import Thread
+from threading import Thread, Lock, current_thread
+from concurrent.futures import Future
 import os
 import util
 import queue
 import time
-import math
-import datetime
+import json
+import secrets
 
 '''
 Write your code inside this class. 
@@ -25,163 +27,467 @@ class Client:
     This is the main Client Class. 
     '''
 
-    def __init__(self, username, dest, port, window_size):
+    def __init__(self, username, dest, port, window_size, session_file=None, unix_path=None):
         self.server_addr = dest
         self.server_port = port
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # A server on the same host can be reached through its Unix socket at unix_path, where nothing needs acknowledging
+        self.local = unix_path is not None
+        if self.local:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            # Binding to an empty path picks an unused abstract address (Linux) for the server to answer to
+            self.sock.bind('')
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind(('', random.randint(10000, 40000)))
         self.sock.settimeout(None)
-        self.sock.bind(('', random.randint(10000, 40000)))
+        # Delivery classes the server accepts, it announces them once we joined
+        self.server_capabilities = set()
         self.name = username
         self.window = window_size
         self.running = True
-        self.message_queue = queue.Queue()
-        self.next_ack = -1
-        self.ack_gotten = -1
-        self.packet_time = None
+        self.outbound = queue.Queue(util.SEND_QUEUE_SIZE)
+        # What the receive thread sends, it never waits for room in outbound, as the ACKs it handles are what makes room
+        self.control = queue.Queue()
+        self.receive_thread = None
+        # The file being sent, so that the server can refuse it while it is in progress
+        self.streaming = None
+        self.download_dir = util.DOWNLOAD_DIR
+        # Files being received, by sender and transfer id, the server sends them in several transfers
+        self.downloads = {}
+        if self.local:
+            self.sender = util.LocalSender(self.sock, unix_path)
+            # The server tells us to pause our streams while it holds back what we sent
+            self.receiver = util.LocalReceiver(self.open_download, sender=self.sender)
+        else:
+            self.sender = util.ReliableSender(self.sock, (self.server_addr, self.server_port), window_size)
+            self.receiver = util.ReliableReceiver(window_size, self.open_download)
+        self.corrupt_packets = 0
+        # Local mirror of the users connected to the cluster while subscribed to presence updates, None when not subscribed.
+        # The version is None while a snapshot is awaited, the updates that arrive meanwhile are pending
+        self.presence = None
+        self.presence_version = None
+        self.presence_pending = []
+        # The session token and the files still being sent are kept in session_file, so that a restarted client can resume them
+        self.session_file = session_file
+        self.session_lock = Lock()
+        self.token = None
+        # The Future join() returned, set once the server answers the join
+        self.joined = None
+        self.transfers = {}
+        self.unfinished = {}
+        # Paths of the files still being received, by `<sender> <transfer id>`, a restarted client continues them
+        self.partial_downloads = {}
+        self.load_session()
+        # Messages are sent by a background thread so that input is never held up by a transfer
+        T = Thread(target=self.sender_loop)
+        T.daemon = True
+        T.start()
 
-    def send_message(self, type, format, data):
+    def send_message(self, type, format, data, delivery=None):
         '''
         This function makes a message, prepares it as a packet, and then sends it to the server using the server address and port
         type defines the type of message (join, disconnect, etc.)
         format defines the format of the message (1, 2, 3, or 4)
         data is the actual message content
+        delivery is the delivery class, by default the one util.MESSAGE_DELIVERY gives the type.
+        Datagrams are only sent once the server announced it accepts them, until then they go reliably
         '''
         message = util.make_message(type, format, data)
-        self.send_reliable_message(message)
+        if delivery is None:
+            delivery = util.MESSAGE_DELIVERY.get(type, util.DELIVERY_RELIABLE)
+        if delivery == util.DELIVERY_DATAGRAM and delivery in self.server_capabilities and self.send_datagram(message):
+            future = Future()
+            future.set_result(True)
+            return future
+        return self.send_reliable_message(message)
+
+    def send_datagram(self, msg):
+        '''
+        Sends a message as a single datagram right away, it is not acknowledged, so nothing tells whether it arrived.
+        Returns False if the message does not fit in one
+        '''
+        if self.local:
+            datagram = ('msg|' + msg).encode('utf-8')
+            if len(datagram) > util.LOCAL_DATAGRAM_SIZE:
+                return False
+            self.sock.sendto(datagram, self.sender.address)
+        else:
+            packet = util.make_datagram(msg)
+            if len(packet) > util.MAX_PACKET_SIZE:
+                return False
+            self.sock.sendto(packet, (self.server_addr, self.server_port))
+        return True
+
+    def join(self):
+        '''
+        Joins the server, announcing the delivery classes we accept.
+        Returns a Future that is set to True once the server confirmed our session, or False if it refused us or never got the join.
+        Only its answer tells that the server handled the join, a join sent over the Unix socket is not acknowledged
+        '''
+        joined = self.joined = Future()
+        sent = self.send_message('join', 1, "%s %s" % (self.name, ' '.join(util.CAPABILITIES)))
+        sent.add_done_callback(lambda sent: sent.result() or self.join_answered(False))
+        return joined
+
+    def join_answered(self, joined):
+        '''
+        Sets the Future join() returned, unless it was set already
+        '''
+        if self.joined is not None and not self.joined.done():
+            self.joined.set_result(joined)
 
     def send_reliable_message(self, msg):
         '''
-        This function splits the message into chunks and sends them with reliability
+        This function queues the message for the sender thread and returns without waiting for it to be sent
+        It returns a Future that is set to True once the server acknowledged the message, or False if the server stopped responding
         '''
-        # Generate a random sequence number for the start packet
-        seq_num = random.randint(1, 1000000)
-        start_seq_num = seq_num
-        
-        # Calculate number of chunks needed
-        x_var = sys.getsizeof(msg)
-        num_of_packets = math.ceil(x_var / util.CHUNK_SIZE)
-        chunk_size = math.ceil(len(msg) / num_of_packets)
-        
-        # Split message into chunks
-        chunks = [msg[i:i+chunk_size] for i in range(0, len(msg), chunk_size)]
-        
-        # Calculate last sequence number
-        num_of_data_packets = len(chunks)
-        last_seq_num = start_seq_num + num_of_data_packets + 2
-        
-        # Reset acknowledgment tracking
-        self.ack_gotten = -1
-        self.next_ack = -1
-        
-        # Send START packet and wait for acknowledgment
-        start_packet = util.make_packet('start', seq_num)
-        self.sock.sendto(start_packet.encode('utf-8'), (self.server_addr, self.server_port))
-        self.packet_time = datetime.datetime.now()
-        
-        # Keep retransmitting START until ACK received
-        self.start_end_transmission(start_seq_num+1, start_packet)
-        # Update ack tracking
-        self.ack_gotten = self.next_ack
-        self.next_ack = -1
-        
-        # Send all data chunks with reliability
-        self.data_transmission(last_seq_num, start_seq_num, chunks)
-        
-        # Send END packet and wait for acknowledgment
-        end_packet = util.make_packet("end", last_seq_num - 1)
-        self.sock.sendto(end_packet.encode('utf-8'), (self.server_addr, self.server_port))
-        self.packet_time = datetime.datetime.now()
-        
-        # Keep retransmitting END until ACK received
-        self.start_end_transmission(last_seq_num, end_packet)
-        # Reset acknowledgment state
-        self.next_ack = -1
-        self.ack_gotten = -1
-    
+        future = Future()
+        self.queue_outbound((msg, future))
+        return future
 
-    def start_end_transmission(self, seq_num, msg_packet):
+    def send_file(self, recipient, path, transfer_id=None):
         '''
-        Handles reliable transmission of START/END packet with retransmission
+        Queues the file at path to be streamed to recipient, it is read from disk while it is being sent
+        The transfer is remembered until the server received it all, a transfer sent again with its transfer_id resumes where it stopped
+        Returns a Future like send_reliable_message()
         '''
-        while True:
-            if self.next_ack == seq_num:
-                break
+        if transfer_id is None:
+            transfer_id = secrets.token_hex(8)
+        size = os.path.getsize(path)
+        header = util.make_message('file', 4, "%s %d %s %s" % (recipient, size, transfer_id, os.path.basename(path)))
+        with self.session_lock:
+            self.transfers[transfer_id] = [recipient, path]
+            self.save_session()
+        future = Future()
+        future.add_done_callback(lambda future: self.transfer_done(transfer_id, future.result()))
+        self.queue_outbound((util.FileStream(path, header), future))
+        return future
 
-            if ((datetime.datetime.now() - self.packet_time) > datetime.timedelta(seconds=0.5)):
-                self.sock.sendto(msg_packet.encode('utf-8'), (self.server_addr, self.server_port))
-                self.packet_time = datetime.datetime.now()
-    
-    def data_transmission(self, last_seq_num, start_seq_num, chunks):
-       while self.ack_gotten != last_seq_num - 1:
-            i = self.ack_gotten - start_seq_num - 1
-            packet = util.make_packet("data", self.ack_gotten, chunks[i])
-            self.sock.sendto(packet.encode('utf-8'), (self.server_addr, self.server_port))
-            self.packet_time = datetime.datetime.now()
-            self.data_retransmission()
-    
-    def data_retransmission(self):
+    def queue_outbound(self, item):
         '''
-        Handles retransmission of data packets if ACK not received in time
+        Queues a message or stream with its Future for the sender thread, waiting for room in outbound.
+        The receive thread queues on control instead and never waits, a None in outbound wakes up the sender thread for it
         '''
-        while not ((datetime.datetime.now() - self.packet_time) > datetime.timedelta(seconds=0.5)):
-            if self.next_ack == self.ack_gotten + 1:
-                self.ack_gotten = self.ack_gotten + 1
-                self.next_ack = -1
-                break
+        if current_thread() is not self.receive_thread:
+            self.outbound.put(item)
+            return
+        self.control.put_nowait(item)
+        try:
+            self.outbound.put_nowait(None)
+        except queue.Full:
+            # The sender thread has items to take, it looks at control before each
+            pass
 
-    def quit_server(self):
+    def next_outbound(self, timeout=None):
         '''
-        This function is used to quit the server and close the socket, while setting the running flag to False in order to stop the main loop
+        Returns the next item for the sender thread, the ones the receive thread queued come first.
+        Waits up to timeout for one, or not at all without a timeout, and raises queue.Empty if there is none
+        '''
+        try:
+            return self.control.get_nowait()
+        except queue.Empty:
+            pass
+        item = self.outbound.get(timeout is not None, timeout)
+        if item is None:
+            return self.control.get_nowait()
+        return item
+
+    def transfer_done(self, transfer_id, sent):
+        '''
+        Forgets a file transfer once the server received all of it, a failed one is resumed with the session
+        '''
+        if sent:
+            with self.session_lock:
+                self.transfers.pop(transfer_id, None)
+                self.save_session()
+
+    def on_file_rejected(self, transfer_id):
+        '''
+        Called when the server refused a file we send, its recipient is unknown. The transfer is given up and forgotten,
+        its Future is set to False
+        '''
+        with self.session_lock:
+            transfer = self.transfers.pop(transfer_id, None)
+            self.save_session()
+        if transfer is not None:
+            print("file rejected: %s to %s" % (transfer[1], transfer[0]))
+        stream = self.streaming
+        if stream is not None and util.parse_message(stream.header).split_body(3)[2] == transfer_id:
+            self.sender.cancel()
+
+    def load_session(self):
+        '''
+        Reads the session token and unfinished file transfers and downloads of this user from the session file
+        '''
+        if self.session_file is None or not os.path.exists(self.session_file):
+            return
+        with open(self.session_file) as session_file:
+            session = json.load(session_file)
+        if session.get('user') == self.name:
+            self.token = session.get('token')
+            self.transfers = session.get('transfers', {})
+            self.unfinished = dict(self.transfers)
+            self.partial_downloads = session.get('downloads', {})
+
+    def save_session(self):
+        '''
+        Writes the session token and unfinished file transfers and downloads to the session file, the caller holds session_lock
+        '''
+        if self.session_file is None:
+            return
+        with open(self.session_file, 'w') as session_file:
+            json.dump({'user': self.name, 'token': self.token, 'transfers': self.transfers,
+                       'downloads': self.partial_downloads}, session_file)
+
+    def on_session(self, token):
+        '''
+        Called when the server confirms our session, the files the previous run was still sending are resumed
+        '''
+        with self.session_lock:
+            replaced = self.token is not None and self.token != token
+            self.token = token
+            self.save_session()
+            unfinished, self.unfinished = self.unfinished, {}
+        self.join_answered(True)
+        # A session that replaced an expired one has lost its presence subscription, a resumed one keeps it
+        if replaced and self.presence is not None:
+            self.subscribe_presence()
+        for transfer_id, (recipient, path) in unfinished.items():
+            if os.path.isfile(path):
+                print("file: resuming", path, "to", recipient)
+                self.send_file(recipient, path, transfer_id)
+
+    def subscribe_presence(self):
+        '''
+        Asks the server for a presence snapshot followed by updates whenever a user joins or leaves
+        '''
+        if self.presence is None:
+            self.presence = set()
+        self.presence_version = None
+        self.presence_pending = []
+        return self.send_message('subscribe_presence', 2, "")
+
+    def on_presence_snapshot(self, body):
+        '''
+        Replaces the local mirror with a snapshot from the server, the body is `<version> <user1> <user2> ...`.
+        The updates that arrived while it was awaited are applied after it
+        '''
+        if self.presence is None:
+            return
+        version, *users = body.split()
+        self.presence = set(users)
+        self.presence_version = int(version)
+        print("list:", ' '.join(sorted(self.presence)))
+        pending, self.presence_pending = self.presence_pending, []
+        for update in sorted(pending, key=lambda update: int(update.split(None, 1)[0])):
+            self.on_presence_update(update)
+
+    def on_presence_update(self, body):
+        '''
+        Applies an update to the local mirror, the body is `<version> +<user> ... -<user> ...`.
+        Updates the snapshot already covers are ignored, a missing one makes us ask for a new snapshot.
+        Updates that arrive while a snapshot is awaited are kept until it arrives, the server may send them first
+        '''
+        if self.presence is None:
+            return
+        if self.presence_version is None:
+            self.presence_pending.append(body)
+            return
+        version, *changes = body.split()
+        version = int(version)
+        if version <= self.presence_version:
+            return
+        if version > self.presence_version + 1:
+            self.subscribe_presence()
+            return
+        self.presence_version = version
+        for change in changes:
+            if change[0] == '+':
+                self.presence.add(change[1:])
+                print("joined:", change[1:])
+            else:
+                self.presence.discard(change[1:])
+                print("left:", change[1:])
+
+    def open_download(self, header):
+        '''
+        Called when the server starts streaming a file to us, the header is `file <length> <sender> <size> <transfer id> <name>`
+        Returns the FileDownload that writes it into the download directory, or None to discard it
+        The next part of a file that is being received continues its download, also one the previous run of the client left unfinished
+        '''
+        message = util.parse_message(header)
+        if message is None or message.type != 'file':
+            return None
+        parts = message.split_body(3)
+        if len(parts) < 4 or not parts[1].isdigit():
+            return None
+        sender, size, transfer_id, name = parts
+        download = self.downloads.get((sender, transfer_id))
+        if download is not None:
+            return download
+        key = "%s %s" % (sender, transfer_id)
+        path = self.partial_downloads.get(key)
+        resume = path is not None and os.path.isfile(path)
+        if not resume:
+            os.makedirs(self.download_dir, exist_ok=True)
+            path = os.path.join(self.download_dir, os.path.basename(name) or 'file')
+
+        def downloaded(download):
+            self.downloads.pop((sender, transfer_id), None)
+            with self.session_lock:
+                self.partial_downloads.pop(key, None)
+                self.save_session()
+            if download.complete and str(download.size) == size:
+                print(f"file: {sender}: {name} saved to {download.path}")
+            else:
+                print(f"file: {sender}: {name} incomplete, {download.size} of {size} bytes received")
+        download = util.FileDownload(path, downloaded, int(size), resume)
+        self.downloads[(sender, transfer_id)] = download
+        with self.session_lock:
+            self.partial_downloads[key] = path
+            self.save_session()
+        return download
+
+    def sender_loop(self):
+        '''
+        Sends the queued messages with reliability, one transfer at a time
+        Messages that queue up while a transfer is in progress go out together in the next transfer, streams are sent on their own
+        '''
+        held = None
+        while self.running:
+            try:
+                if held is not None:
+                    item, held = held, None
+                else:
+                    item = self.next_outbound(util.TIME_OUT)
+            except queue.Empty:
+                continue
+            batch = [item]
+            while isinstance(item[0], str) and len(batch) < util.MAX_BATCH:
+                try:
+                    item = self.next_outbound()
+                except queue.Empty:
+                    break
+                if not isinstance(item[0], str):
+                    held = item
+                    break
+                batch.append(item)
+            try:
+                if isinstance(batch[0][0], str):
+                    sent = self.sender.send(util.make_chunks(' '.join(msg for msg, _ in batch)))
+                else:
+                    self.streaming = batch[0][0]
+                    sent = self.sender.send(batch[0][0], batch[0][0].header)
+            except OSError:
+                sent = False
+            self.streaming = None
+            # A stream the server refused was cancelled, the server is still there
+            if not sent and self.running and not self.sender.cancelled:
+                print("server not responding")
+            for _, future in batch:
+                future.set_result(sent)
+
+    def close(self):
+        '''
+        This function is used to stop the client and close the socket, while setting the running flag to False in order to stop the main loop
         '''
         self.running = False
         self.sock.close()
+
+    def quit_server(self):
+        '''
+        This function is used to quit the server and close the socket, while setting the running flag to False in order to stop the main loop
+        '''
+        self.close()
         sys.exit()
 
+    def handle_input(self, msg):
+        '''
+        Processes one line of user input
+        Returns the Future of the message sent to the server for it, or None if nothing was sent
+        '''
+        # Extracts the user input into a list of words
+        message = msg.split()
+        if not message:
+            return None
+        # Checks if user input is list. If there is more than one word, it sends an error message, otherwise sends server a request for the user list
+        if message[0] == 'list':
+            if len(message) > 1:
+                return self.send_message('err', 2, "")
+            # While subscribed to presence updates the list is kept up to date locally
+            if self.presence is not None and self.presence_version is not None:
+                print("list:", ' '.join(sorted(self.presence)))
+                return None
+            return self.send_message('request_users_list', 2, "")
+        # Checks if user input is watch or unwatch, which subscribe to presence updates or stop them
+        elif message[0] == 'watch':
+            if len(message) > 1:
+                return self.send_message('err', 2, "")
+            return self.subscribe_presence()
+        elif message[0] == 'unwatch':
+            if len(message) > 1:
+                return self.send_message('err', 2, "")
+            self.presence = None
+            self.presence_version = None
+            return self.send_message('unsubscribe_presence', 2, "")
+        # Checks if user input is quit. If there is more than one word, it sends an error message, otherwise sends server a disconnect message and quits
+        elif message[0] == 'quit':
+            if len(message) > 1:
+                return self.send_message('err', 2, "")
+            print("quitting")
+            # Wait for everything queued, including the disconnect, to reach the server
+            self.send_message('disconnect', 1, self.name).result()
+            # The server ends the session, files not sent yet are sent again on the next join
+            with self.session_lock:
+                self.token = None
+                self.save_session()
+            self.quit_server()
+        # Checks if user input is msg and sends the content to the server
+        elif message[0] == 'msg':
+            return self.send_message('send_message', 4, msg[4:])
+        # Checks if user input is typing and tells the users listed that we are typing to them, if the message is lost nobody minds
+        elif message[0] == 'typing':
+            return self.send_message('typing', 4, msg[7:])
+        # Checks if user input is file and streams the named file to the user
+        elif message[0] == 'file':
+            if len(message) < 3:
+                return self.send_message('err', 2, "")
+            path = msg.split(None, 2)[2]
+            if not os.path.isfile(path):
+                print("no such file:", path)
+                return None
+            return self.send_file(message[1], path)
+        # Checks if user input is help. If there is more than one word, it sends an error message, otherwise prints list of possible commands and their formatting
+        elif message[0] == 'help':
+            if len(message) > 1:
+                return self.send_message('err', 2, "")
+            print("Input for sending message (... to represent possibility for multiple users): msg <num of users to be messaged> <user1> <user2> ... <message>")
+            print("Input for accesing client list: list")
+            print("Input for following users joining and leaving: watch, and unwatch to stop")
+            print("Input for sending a file to a user: file <user> <path>")
+            print("Input for telling users you are typing to them: typing <num of users> <user1> <user2> ...")
+            print("Input for viewing all user-inputs and their format input: help")
+            print("Input for disconnecting from server: quit")
+        # If the input is not recognized, it prints an error message
+        else:
+            print("incorrect userinput format")
+        return None
+
     def start(self):
         '''
         Main Loop is here
-        Start by sending the server a JOIN message. 
+        Start by sending the server a JOIN message, or a RESUME message if we have a session to resume.
         Use make_message() and make_util() functions from util.py to make your first join packet
         Waits for userinput and then process it
         '''
-        self.send_message('join', 1, self.name)
+        if self.token:
+            self.send_message('resume', 4, "%s %s" % (self.name, self.token))
+        else:
+            self.join()
         while self.running:
             try:
-                # Waits for user input and extracts it into a list of words
-                msg = input()
-                if not msg.strip(): 
-                    continue
-                message = msg.split()
-                # Checks if user input is list. If there is more than one word, it sends an error message, otherwise sends server a request for the user list
-                if message[0] == 'list':
-                    if len(message) > 1:
-                        self.send_message('err', 2, "")
-                        continue
-                    self.send_message('request_users_list', 2, "")
-                # Checks if user input is quit. If there is more than one word, it sends an error message, otherwise sends server a disconnect message and quits
-                elif message[0] == 'quit':
-                    if len(message) > 1:
-                        self.send_message('err', 2, "")
-                        continue
-                    print("quitting")
-                    self.send_message('disconnect', 1, self.name)
-                    self.quit_server()
-                    break
-                # Checks if user input is msg and sends the content to the server
-                elif message[0] == 'msg':
-                    self.send_message('send_message', 4, msg[4:])
-                # Checks if user input is help. If there is more than one word, it sends an error message, otherwise prints list of possible commands and their formatting
-                elif message[0] == 'help':
-                    if len(message) > 1:
-                        self.send_message('err', 2, "")
-                        continue
-                    print("Input for sending message (... to represent possibility for multiple users): msg <num of users to be messaged> <user1> <user2> ... <message>")
-                    print("Input for accesing client list: list")
-                    print("Input for viewing all user-inputs and their format input: help")
-                    print("Input for disconnecting from server: quit")
-                # If the input is not recognized, it prints an error message
-                else:
-                    print("incorrect userinput format")
+                # Waits for user input and processes it
+                self.handle_input(input())
             # Handles any exceptions that may occur during user input processing
             except Exception as e:
                 if not self.running:
@@ -193,71 +499,253 @@ class Client:
         '''
         Manages different types of packets received from the server
         '''
+        if self.local:
+            recv_msg = self.receiver.on_datagram(message)
+            return recv_msg if recv_msg is not None else " "
+        # Drop corrupted packets before they reach the reassembly or get acknowledged
+        if not util.verify_packet(message):
+            self.corrupt_packets += 1
+            return " "
         msg_type, seq_num, recv_msg, _ = util.parse_packet(message.decode('utf-8'))
         seq_num = int(seq_num)
+
+        # A message the server sent as a datagram is complete on its own and not acknowledged
+        if util.is_datagram(msg_type, seq_num):
+            return recv_msg
         
         if msg_type == 'ack':
-            self.next_ack = seq_num
+            self.sender.on_ack(seq_num, *util.parse_ack(recv_msg))
             return " "
         
-        # For data packets, we should send an ACK
+        # For start, data and end packets, we should send an ACK
         if msg_type in ['start', 'data', 'end']:
-            # Send the ACK
-            msg = util.make_message('ack', 2,)
-            msg = util.make_packet('ack', int(seq_num + 1), msg)
-            self.sock.sendto(msg.encode("utf-8"), client_addr)  
-            # If it's a data packet, return the message content
-            if msg_type == 'data':
-                return recv_msg
+            ack_num, recv_msg_result = self.receiver.on_packet(msg_type, seq_num, recv_msg)
+            # A delayed ACK is sent by receive_handler() if no other packet comes first
+            if ack_num is not None:
+                # The START of a file we hold part of tells the server where to continue
+                offset = self.receiver.resume_offset if msg_type == 'start' else 0
+                self.sock.sendto(util.make_ack(ack_num, self.receiver.advertised_window(), offset), client_addr)
+            # Once the whole message has arrived, return its content
+            if recv_msg_result is not None:
+                return recv_msg_result
                 
         return " "
 
+    def process_message(self, message):
+        '''
+        Processes a single message from the server based on its type
+        '''
+        message_type = message.type
+        if message_type == 'response_users_list':
+            users = message.body
+            print("list:", users)
+        elif message_type == 'forward_message':
+            sender, _, message_content = message.body.partition(' ')
+            print(f"msg: {sender}: {message_content}")
+        elif message_type == 'forward_typing':
+            print("typing:", message.body)
+        elif message_type == 'capabilities':
+            self.server_capabilities = set(message.split_body())
+        elif message_type == 'presence_snapshot':
+            self.on_presence_snapshot(message.body)
+        elif message_type == 'presence_update':
+            self.on_presence_update(message.body)
+        elif message_type == 'file_incomplete':
+            # The sender of a file stopped before all of it arrived
+            sender, _, transfer_id = message.body.partition(' ')
+            download = self.downloads.get((sender, transfer_id))
+            if download is not None:
+                download.abort()
+        elif message_type == 'err_file_rejected':
+            self.on_file_rejected(message.body)
+        elif message_type == 'session':
+            self.on_session(message.body)
+        elif message_type == 'err_session_invalid':
+            # The server no longer knows our session, start a new one
+            print('session expired, joining again')
+            self.join()
+        elif message_type == 'err_rate_limited':
+            # The server dropped what we sent over our rate limit, we stay connected
+            print('rate limited: messages dropped by the server')
+        elif message_type == 'err_server_full':
+            print('disconnected: server full')
+            self.join_answered(False)
+            self.quit_server()
+        elif message_type == 'err_username_unavailable':
+            print('disconnected: username not available')
+            self.join_answered(False)
+            self.quit_server()
+        elif message_type == 'err_unknown_message':
+            print('disconnected: server received an unknown command')
+            self.quit_server()
+
     def receive_handler(self):
         '''
         Waits for a message from server and process it accordingly
         '''
+        self.receive_thread = current_thread()
         while self.running:
             try:
+                # Only wait for the next packet as long as a delayed ACK can wait
+                if self.receiver.ack_deadline is not None:
+                    timeout = max(0, self.receiver.ack_deadline - time.monotonic())
+                    if not select.select([self.sock], [], [], timeout)[0]:
+                        ack_num = self.receiver.delayed_ack()
+                        if ack_num is not None:
+                            self.sock.sendto(util.make_ack(ack_num, self.receiver.advertised_window()),
+                                             (self.server_addr, self.server_port))
+                        continue
                 # Receive message from server
-                message, server_address = self.sock.recvfrom(4096)
+                message, server_address = self.sock.recvfrom(util.LOCAL_DATAGRAM_SIZE if self.local else 4096)
                 
                 # Process the message based on its type
                 recv_msg = self.packet_receiver(message, server_address)
                 
                 if recv_msg != " ":
-                    # Split the message to get its type and content
-                    parts = recv_msg.split()
-                    if len(parts) < 1:
-                        continue
-                        
-                    message_type = parts[0]
-                    
-                    # Process message based on its type
-                    if message_type == 'response_users_list':
-                        users = ' '.join(parts[2:])
-                        print("list:", users)
-                    elif message_type == 'forward_message':
-                        sender = parts[2]
-                        message_content = ' '.join(parts[3:])
-                        print(f"msg: {sender}: {message_content}")
-                    elif message_type == 'err_server_full':
-                        print('disconnected: server full')
-                        self.quit_server()
-                        break
-                    elif message_type == 'err_username_unavailable':
-                        print('disconnected: username not available')
-                        self.quit_server()
-                        break
-                    elif message_type == 'err_unknown_message':
-                        print('disconnected: server received an unknown command')
-                        self.quit_server()
-                        break
+                    # A transfer can carry several messages, process them in order
+                    for message in util.iter_messages(recv_msg):
+                        self.process_message(message)
             except Exception as e:
                 if not self.running:
                     break
                 print(f"Error in client receiving: {e}")
                 continue
 
+def read_commands(stream, default_user=None):
+    '''
+    Yields (username, command) pairs from a stream of commands, one per line
+    A line is either a command exactly as it would be typed interactively, sent as default_user,
+    or a JSON object naming its "user" and "command".
+    JSON objects without a command, such as the entries of requests.jsonl, become a message with their "body" or "title" as the text,
+    sent to the users listed in "to", or back to the sending user if there is none
+    '''
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith('{'):
+            yield default_user, line
+            continue
+        entry = json.loads(line)
+        username = entry.get('user', default_user)
+        command = entry.get('command')
+        if command is None:
+            recipients = entry.get('to') or [username]
+            if isinstance(recipients, str):
+                recipients = recipients.split()
+            text = ' '.join(str(entry.get(key, '')) for key in ('body', 'title') if entry.get(key))
+            command = "msg %d %s %s" % (len(recipients), ' '.join(recipients), ' '.join(text.split()))
+        yield username, command
+
+
+class Replay:
+    '''
+    Headless client mode: replays a stream of commands instead of reading user input
+    Every user named in the stream gets its own Client in this process and joins when it is first used
+    rate is the number of commands sent per second, 0 sends them as fast as possible
+    The time each command was sent and the time the server acknowledged it are recorded
+    '''
+    def __init__(self, dest, port, window_size, rate=0, download_dir=util.DOWNLOAD_DIR, unix_path=None):
+        self.server_addr = dest
+        self.server_port = port
+        self.unix_path = unix_path
+        self.window = window_size
+        self.rate = rate
+        self.download_dir = download_dir
+        self.clients = {}
+        self.records = []
+
+    def get_client(self, username):
+        '''
+        Returns the client for username, creating it and waiting for the server to confirm its join on first use
+        '''
+        client = self.clients.get(username)
+        if client is None:
+            client = Client(username, self.server_addr, self.server_port, self.window, unix_path=self.unix_path)
+            client.download_dir = self.download_dir
+            T = Thread(target=client.receive_handler)
+            T.daemon = True
+            T.start()
+            client.join().result()
+            self.clients[username] = client
+        return client
+
+    def send(self, username, command):
+        '''
+        Sends one command as username and records when it was sent and acknowledged
+        '''
+        client = self.get_client(username)
+        record = {'user': username, 'command': command, 'sent': time.time(), 'acked': None, 'ok': None}
+        if command.split()[0] == 'quit':
+            # Leave without exiting the process, the user joins again if it is used later
+            future = client.send_message('disconnect', 1, username)
+            del self.clients[username]
+            future.add_done_callback(lambda _, client=client: client.close())
+        else:
+            future = client.handle_input(command)
+        if future is None:
+            return None
+        self.records.append(record)
+
+        def acknowledged(future, record=record):
+            record['acked'] = time.time()
+            record['ok'] = future.result()
+        future.add_done_callback(acknowledged)
+        return future
+
+    def run(self, commands):
+        '''
+        Replays the (username, command) pairs at the configured rate and waits until every command was acknowledged
+        '''
+        futures = []
+        interval = 1 / self.rate if self.rate else 0
+        next_send = time.monotonic()
+        for username, command in commands:
+            if username is None:
+                print("no user for command:", command)
+                continue
+            if interval:
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_send += interval
+            future = self.send(username, command)
+            if future is not None:
+                futures.append(future)
+        for future in futures:
+            future.result()
+
+    def summary(self):
+        '''
+        Returns a one line summary of the replay: commands sent, failures, throughput and ACK latencies
+        '''
+        if not self.records:
+            return "replayed 0 commands"
+        latencies = sorted(record['acked'] - record['sent'] for record in self.records)
+        failed = sum(1 for record in self.records if not record['ok'])
+        elapsed = max(record['acked'] for record in self.records) - self.records[0]['sent']
+        return "replayed %d commands, %d failed, %.1f commands/s, ack latency p50 %.1fms p99 %.1fms" % (
+            len(self.records), failed, len(self.records) / elapsed if elapsed > 0 else 0,
+            latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000)
+
+    def write_log(self, path):
+        '''
+        Writes the recorded commands with their send and ACK timestamps to path as JSON lines
+        '''
+        with open(path, 'w') as log_file:
+            for record in self.records:
+                log_file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        '''
+        Disconnects every client that is still joined
+        '''
+        futures = [(client, client.send_message('disconnect', 1, username)) for username, client in self.clients.items()]
+        for client, future in futures:
+            future.result()
+            client.close()
+        self.clients = {}
+
 # Do not change below part of code
 if __name__ == "__main__":
     def helper():
@@ -269,10 +757,19 @@ if __name__ == "__main__":
         print("-p PORT | --port=PORT The server port, defaults to 15000")
         print("-a ADDRESS | --address=ADDRESS The server ip or hostname, defaults to localhost")
         print("-w WINDOW_SIZE | --window=WINDOW_SIZE The window_size, defaults to 3")
+        print("-t TRACE_FILE | --trace=TRACE_FILE Record sampled timing spans and write them to TRACE_FILE on exit")
+        print("--trace-rate=RATE The fraction of messages traced, defaults to 0.01")
+        print("-d DIRECTORY | --downloads=DIRECTORY Where received files are saved, defaults to %s" % util.DOWNLOAD_DIR)
+        print("-f FILE | --file=FILE Replay the commands in FILE (- for stdin) instead of reading user input, plain lines or JSON lines")
+        print("-r RATE | --rate=RATE Commands replayed per second, defaults to 0 which replays as fast as possible")
+        print("-l LOG_FILE | --log=LOG_FILE Write the send and ACK time of every replayed command to LOG_FILE")
+        print("-s SESSION_FILE | --session=SESSION_FILE Keep the session in SESSION_FILE and resume it when the client is restarted")
+        print("-U PATH | --unix=PATH Connect through the Unix socket at PATH of a server on the same host instead of UDP")
         print("-h | --help Print this help")
     try:
         OPTS, ARGS = getopt.getopt(sys.argv[1:],
-                                   "u:p:a:w", ["user=", "port=", "address=","window="])
+                                   "u:p:a:w:t:d:f:r:l:s:U:", ["user=", "port=", "address=","window=", "trace=", "trace-rate=",
+                                                            "downloads=", "file=", "rate=", "log=", "session=", "unix="])
     except getopt.error:
         helper()
         exit(1)
@@ -281,22 +778,64 @@ if __name__ == "__main__":
     DEST = "localhost"
     USER_NAME = None
     WINDOW_SIZE = 3
+    TRACE_FILE = None
+    TRACE_RATE = util.TRACE_SAMPLE_RATE
+    DOWNLOAD_DIR = util.DOWNLOAD_DIR
+    SCRIPT_FILE = None
+    RATE = 0
+    LOG_FILE = None
+    SESSION_FILE = None
+    UNIX_PATH = None
     for o, a in OPTS:
-        if o in ("-u", "--user="):
+        if o in ("-u", "--user"):
             USER_NAME = a
-        elif o in ("-p", "--port="):
+        elif o in ("-p", "--port"):
             PORT = int(a)
-        elif o in ("-a", "--address="):
+        elif o in ("-a", "--address"):
             DEST = a
-        elif o in ("-w", "--window="):
+        elif o in ("-w", "--window"):
             WINDOW_SIZE = a
+        elif o in ("-t", "--trace"):
+            TRACE_FILE = a
+        elif o == "--trace-rate":
+            TRACE_RATE = float(a)
+        elif o in ("-d", "--downloads"):
+            DOWNLOAD_DIR = a
+        elif o in ("-f", "--file"):
+            SCRIPT_FILE = a
+        elif o in ("-r", "--rate"):
+            RATE = float(a)
+        elif o in ("-l", "--log"):
+            LOG_FILE = a
+        elif o in ("-s", "--session"):
+            SESSION_FILE = a
+        elif o in ("-U", "--unix"):
+            UNIX_PATH = a
+
+    if SCRIPT_FILE is not None:
+        # Headless mode, the commands name their own users so -u is only the default
+        R = Replay(DEST, PORT, WINDOW_SIZE, RATE, DOWNLOAD_DIR, UNIX_PATH)
+        try:
+            with (sys.stdin if SCRIPT_FILE == '-' else open(SCRIPT_FILE)) as stream:
+                R.run(read_commands(stream, USER_NAME))
+        except KeyboardInterrupt:
+            pass
+        print(R.summary())
+        if LOG_FILE:
+            R.write_log(LOG_FILE)
+        R.close()
+        sys.exit()
 
     if USER_NAME is None:
         print("Missing Username.")
         helper()
         exit(1)
 
-    S = Client(USER_NAME, DEST, PORT, WINDOW_SIZE)
+    if TRACE_FILE:
+        util.enable_tracing(TRACE_RATE)
+
+    S = Client(USER_NAME, DEST, PORT, WINDOW_SIZE, SESSION_FILE, UNIX_PATH)
+    S.download_dir = DOWNLOAD_DIR
     try:
         # Start receiving Messages
         T = Thread(target=S.receive_handler)
@@ -305,4 +844,6 @@ if __name__ == "__main__":
         # Start Client
         S.start()
     except (KeyboardInterrupt, SystemExit):
+        if util.TRACER:
+            util.TRACER.export(TRACE_FILE)
         sys.exit()
\ No newline at end of file
@@ -19,6 +19,13 @@ class Server:
         self.sock.bind((self.server_addr, self.server_port))
         self.window = window
         self.clients = {}
+        #Handlers for each message type a client can send
+        self.handlers = {
+            'join': self.handle_join,
+            'request_users_list': self.handle_request_users_list,
+            'send_message': self.handle_send_message,
+            'disconnect': self.handle_disconnect,
+        }
 
     def send_message(self, type, format, data, clientaddress):
         '''
@@ -39,6 +46,74 @@ class Server:
         self.clients.pop(clientaddress)
         self.send_message('err_unknown_message', 2, "")
 
+    def handle_join(self, message, client_address):
+        '''
+        If the server is full or if the username is already taken it sends appropriate error messages, otherwise adds the client to the clients dictionary and prints a join message
+        '''
+        username = message.split_body(1)[0]
+        if len(self.clients) >= util.MAX_NUM_CLIENTS:
+            self.send_message('err_server_full', 2, "", client_address)
+            print('disconnected: server full')
+        elif username in self.clients.values():
+            self.send_message('err_username_unavailable', 2, "", client_address)
+            print('disconnected: username not available')
+        else:
+            self.clients[client_address] = username
+            print("join:", username)
+
+    def handle_request_users_list(self, message, client_address):
+        '''
+        Sends the sorted list of users to the client
+        '''
+        username = self.clients[client_address]
+        print("request_users_list: " + username)
+        userlist = list(self.clients.values())
+        userlist = sorted(userlist)
+        resp = ' '.join(userlist)
+        self.send_message('response_users_list', 3, resp, client_address)
+
+    def handle_send_message(self, message, client_address):
+        '''
+        If the message data is valid, it sends the message to the specified users, otherwise sends an unknown error message
+        '''
+        print("msg: " + self.clients[client_address])
+        parts = message.split_body(1)
+        if len(parts) < 2:
+            self.unknown_error(client_address)
+            return
+        elif parts[0] not in ['1', '2', '3', '4' ,'5' ,'6' ,'7' , '8', '9', '10']:
+            self.unknown_error(client_address)
+            return
+        #Extracts the number of users to be messaged, the list of users and the message content, which is forwarded without being split up
+        numusers = int(parts[0])
+        rest = parts[1].split(None, numusers)
+        messageuserlist = rest[:numusers]
+        sentmessage = rest[numusers] if len(rest) > numusers else ''
+        #Checks if the number of users in the message matches the number of users specified, otherwise sends an unknown error message
+        if len(messageuserlist) != numusers:
+            self.unknown_error(client_address)
+            return
+        #Iterates through the list of users and sends the message to each user if they are in the clients dictionary, otherwise prints an error message
+        for user in messageuserlist:
+            if user in self.clients.values():
+                useraddress = next((addr for addr, name in self.clients.items() if name == user), None)
+                self.send_message('forward_message', 4, self.clients[client_address] + ' ' + sentmessage, useraddress)
+            else:
+                print("msg:", self.clients[client_address], "to non-existent user", user)
+
+    def handle_disconnect(self, message, client_address):
+        '''
+        Removes the client from the clients dictionary and prints disconnect message
+        '''
+        print('disconnected:', self.clients[client_address])
+        self.clients.pop(client_address)
+
+    def handle_unknown(self, message, client_address):
+        '''
+        Sends an unknown error message for message types the server does not recognize
+        '''
+        self.unknown_error(client_address)
+
     def start(self):
         '''
         Main loop.
@@ -47,59 +122,13 @@ class Server:
         '''
         while True:
             try:
-                #Extracts the message type, length, data and server address from the received message
-                message_type, message_length, message_data, client_address = util.handle_message(self.sock)
-                #Checks if message_type is join and if the server is full or if the username is already taken it sends appropriate error messages, otherwise adds the client to the clients dictionary and prints a join message
-                if message_type == 'join':
-                    if len(self.clients) >= util.MAX_NUM_CLIENTS:
-                        self.send_message('err_server_full', 2, "", client_address)
-                        print('disconnected: server full')
-                    elif message_data[0] in self.clients.values():
-                        self.send_message('err_username_unavailable', 2, "", client_address)
-                        print('disconnected: username not available')
-                    else:
-                        self.clients[client_address] = message_data[0]
-                        print("join:", message_data[0])
-                #Checks if message_type is request_users_list and sends the sorted list of users to the client
-                elif message_type == 'request_users_list':
-                    username = self.clients[client_address]
-                    print("request_users_list: " + username)
-                    userlist = list(self.clients.values())
-                    userlist = sorted(userlist)
-                    resp = ' '.join(userlist)
-                    self.send_message('response_users_list', 3, resp, client_address)
-                #Checks if message_type is send_message and if the message data is valid, it sends the message to the specified users, otherwise sends an unknown error message
-                elif message_type == 'send_message':
-                    print("msg: " + self.clients[client_address])
-                    if len(message_data) < 2:
-                        self.unknown_error(client_address)
-                        continue
-                    elif message_data[0] not in ['1', '2', '3', '4' ,'5' ,'6' ,'7' , '8', '9', '10']:
-                        self.unknown_error(client_address)
-                        continue
-                    #Extracts the number of users to be messaged, the list of users and the message content
-                    numusers = int(message_data[0])
-                    help = numusers + 1
-                    messageuserlist = message_data[1:help]
-                    sentmessage = message_data[help:]
-                    #Checks if the number of users in the message matches the number of users specified, otherwise sends an unknown error message
-                    if len(messageuserlist) != numusers:
-                        self.unknown_error(client_address)
-                        continue
-                    #Iterates through the list of users and sends the message to each user if they are in the clients dictionary, otherwise prints an error message
-                    for user in messageuserlist:
-                        if user in self.clients.values():
-                            useraddress = next((addr for addr, name in self.clients.items() if name == user), None)
-                            self.send_message('forward_message', 4, ' '.join([self.clients[client_address]] + sentmessage), useraddress)
-                        else:
-                            print("msg:", self.clients[client_address], "to non-existent user", user)
-                #Checks if message_type is disconnect and removes the client from the clients dictionary and prints disconnect message, otherwise sends an unknown error message
-                elif message_type == 'disconnect':
-                    print('disconnected:', self.clients[client_address])
-                    self.clients.pop(client_address)
-                #If message_type is not recognized, it sends an unknown error message
-                else:
-                    self.unknown_error(client_address)
+                #Extracts the message and the client address from the received packet
+                message, client_address = util.handle_message(self.sock)
+                if message is None:
+                    continue
+                #Looks up the handler for the message type, unrecognized types send an unknown error message
+                handler = self.handlers.get(message.type, self.handle_unknown)
+                handler(message, client_address)
             #Handles any exceptions that may occur during message processing
             except Exception as e:
                 print(f"Error in server: {e}")
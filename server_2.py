@@ -2,307 +2,984 @@
 This module defines the behaviour of server in your Chat Application
 '''
 import sys
+import os
 import getopt
 import socket
+import select
 import util
 import queue
 import threading
-import random
+import secrets
 import time
-import datetime
-import math
 
 class Server:
     '''
     This is the main Server Class. You will write Server code inside this class.
     '''
-    def __init__(self, dest, port, window):
+    def __init__(self, dest, port, window, overflow_policy='drop_oldest', queue_size=util.SEND_QUEUE_SIZE, peers=(),
+                 rate_limit=util.RATE_LIMIT_MESSAGES, byte_limit=util.RATE_LIMIT_BYTES, burst=util.RATE_LIMIT_BURST,
+                 workers=util.DISPATCH_WORKERS, unix_path=None, cluster_key=None):
         self.server_addr = dest
         self.server_port = port
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.settimeout(None)
         self.sock.bind((self.server_addr, self.server_port))
-        self.window = window
+        # Clients on the same host can also connect through a Unix datagram socket, see util.LocalSender
+        self.local_sock = None
+        if unix_path is not None:
+            if os.path.exists(unix_path):
+                os.unlink(unix_path)
+            self.local_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.local_sock.bind(unix_path)
+            # Written to when a relay has space again, so that local_loop passes on what it held back for it
+            self.local_wakeup, self.local_wakeup_writer = socket.socketpair()
+            self.local_wakeup_writer.setblocking(False)
+        self.window = int(window)
+        self.overflow_policy = overflow_policy
+        self.queue_size = queue_size
         self.clients = {}
-        self.client_messages = {}
-        self.ack_num_next = {}
-        self.expected_seq = {}
-        self.ack_gotten = {}
-        self.packet_times = {}
+        # Held while a client is added, so that two workers can not both admit the same username
+        self.clients_lock = threading.Lock()
+        self.receivers = {}
+        self.senders = {}
+        self.send_queues = {}
+        self.send_lock = threading.Lock()
+        # Session token of each connected user, a client that comes back with it resumes the session
+        self.sessions = {}
+        # Relays of the files being streamed, by sender and transfer id, so that interrupted transfers can be resumed
+        self.transfers = {}
+        # Other server nodes of the cluster: the users connected to each peer, the node each remote user is connected to,
+        # and the nodes to keep trying to peer with
+        self.address = (socket.gethostbyname(dest), port)
+        self.peers = {}
+        self.routes = {}
+        self.seeds = list(peers)
+        # Nodes that may peer with us: the seeds and the nodes our peers name, any other node has to send the cluster key
+        self.known_nodes = set(self.seeds)
+        self.cluster_key = cluster_key
+        self.node_lock = threading.Lock()
+        # Clients subscribed to presence updates, and the version of the last update, a client that misses one asks for a snapshot
+        self.subscribers = set()
+        self.presence_version = 0
+        self.presence_lock = threading.Lock()
+        self.corrupt_packets = 0
+        # Delivery classes each client announced at join, by client address
+        self.capabilities = {}
+        # Token buckets limiting the messages each client sends, by client address
+        self.rate_limit = rate_limit
+        self.byte_limit = byte_limit
+        self.burst = burst
+        self.rate_limiters = {}
+        # Receivers holding back an ACK, by client address
+        self.delayed_acks = {}
+        # Received messages waiting for the dispatch workers, the messages of a client always go to the same worker to keep their order
+        self.dispatch_queues = [queue.Queue(util.DISPATCH_QUEUE_SIZE) for _ in range(max(1, int(workers)))]
+        # Held while adding to the dispatch queues, the workers notify it when they take an item
+        self.dispatch_room = threading.Condition(threading.RLock())
+        # Handlers for each message type a client can send
+        self.handlers = {
+            'join': self.handle_join,
+            'resume': self.handle_resume,
+            'request_users_list': self.handle_request_users_list,
+            'typing': self.handle_typing,
+            'subscribe_presence': self.handle_subscribe_presence,
+            'unsubscribe_presence': self.handle_unsubscribe_presence,
+            'send_message': self.handle_send_message,
+            'disconnect': self.handle_disconnect,
+            'node_join': self.handle_node_join,
+            'node_presence': self.handle_node_presence,
+            'node_peers': self.handle_node_peers,
+            'node_forward': self.handle_node_forward,
+        }
 
-    def send_message(self, type, format, data, clientaddress):
+    def send_message(self, type, format, data, clientaddress, capabilities=None):
         '''
         This function makes a message, prepares it as a packet, and then sends it to the client using the client address
         type defines the type of message 
         format defines the format of the message (1, 2, 3, or 4)
         data is the actual message content
+        capabilities are the delivery classes the client accepts, by default the ones it joined with
         '''
+        if capabilities is None:
+            capabilities = self.capabilities.get(clientaddress)
         message = util.make_message(type, format, data)
-        self.make_thread(message, clientaddress)
-    
-    def make_thread(self, msg, client_address):
+        if self.delivery(type, clientaddress, capabilities) == util.DELIVERY_DATAGRAM:
+            if self.send_datagram(message, clientaddress):
+                return
+            # Too long for a datagram, a client that only takes datagrams can not get it at all
+            if util.DELIVERY_RELIABLE not in (capabilities or {util.DELIVERY_RELIABLE}):
+                print("failed to deliver message to", self.clients.get(clientaddress, clientaddress))
+                return
+        self.enqueue_message(message, clientaddress, util.MESSAGE_PRIORITIES.get(type, util.PRIORITY_CONTROL))
+
+    def delivery(self, type, client_address, capabilities=None):
+        '''
+        Returns the delivery class a message of the given type is sent to the client with, capabilities default to the ones it joined with.
+        Clients that only announced datagrams get every message as one, peer nodes and clients that have not joined get reliable ones
+        '''
+        if capabilities is None:
+            capabilities = self.capabilities.get(client_address)
+        if capabilities is None:
+            return util.DELIVERY_RELIABLE
+        if util.DELIVERY_RELIABLE not in capabilities:
+            return util.DELIVERY_DATAGRAM
+        if util.DELIVERY_DATAGRAM not in capabilities:
+            return util.DELIVERY_RELIABLE
+        return util.MESSAGE_DELIVERY.get(type, util.DELIVERY_RELIABLE)
+
+    def send_datagram(self, msg, client_address):
+        '''
+        Sends a message as a single datagram, right away and without any state: it is not queued, acknowledged or retransmitted.
+        Returns False if the message does not fit in one
+        '''
+        if isinstance(client_address, tuple):
+            packet = util.make_datagram(msg)
+            if len(packet) > util.MAX_PACKET_SIZE:
+                return False
+            self.sock.sendto(packet, client_address)
+        else:
+            datagram = ('msg|' + msg).encode('utf-8')
+            if len(datagram) > util.LOCAL_DATAGRAM_SIZE:
+                return False
+            try:
+                # A full queue at the client would block us, the message is then sent reliably instead
+                self.local_sock.sendto(datagram, socket.MSG_DONTWAIT, client_address)
+            except OSError:
+                return False
+        return True
+
+    def enqueue_message(self, msg, client_address, priority=util.PRIORITY_CONTROL):
+        '''
+        Queues a message in its priority class for the client's sender thread, starting the thread if the client has none.
+        A full queue is waited on while the client keeps acknowledging what is sent to it. Once it made no progress for
+        STALL_TIME_OUT the overflow policy decides between blocking on, dropping the oldest queued message of the lowest class,
+        or disconnecting the client
         '''
-        Create a thread to handle message chunking and sending
+        with self.send_lock:
+            send_queue = self.send_queues.get(client_address)
+            if send_queue is None:
+                send_queue = util.SendQueue(self.queue_size)
+                self.send_queues[client_address] = send_queue
+                sender = self.make_sender(client_address)
+                self.senders[client_address] = sender
+                self.make_thread(sender, send_queue)
+            sender = self.senders[client_address]
+            try:
+                send_queue.put_nowait(msg, priority)
+                return
+            except queue.Full:
+                pass
+        # Wait outside send_lock, the receive loop keeps handling the ACKs that drain the queue
+        while self.overflow_policy == 'block' or time.monotonic() - sender.last_progress <= util.STALL_TIME_OUT:
+            if self.send_queues.get(client_address) is not send_queue:
+                return
+            try:
+                send_queue.put(msg, priority, timeout=util.TIME_OUT)
+                return
+            except queue.Full:
+                continue
+        if self.overflow_policy == 'drop_oldest':
+            with self.send_lock:
+                try:
+                    send_queue.drop()
+                except queue.Empty:
+                    # Only streams are queued and they are never dropped, a new stream is queued past the limit
+                    # and a new message is dropped instead
+                    if not isinstance(msg, str):
+                        send_queue.push(msg, priority)
+                    return
+                try:
+                    send_queue.put_nowait(msg, priority)
+                except queue.Full:
+                    # The sender thread requeued a stream in the meantime
+                    send_queue.push(msg, priority)
+            return
+        self.disconnect_slow_client(client_address)
+
+    def make_sender(self, client_address):
+        '''
+        Returns the sender for a new client, a client connected through the Unix socket has a socket address instead of a (host, port) pair
         '''
-        T = threading.Thread(target=self.send_reliable_message, args=(msg, client_address))
+        if isinstance(client_address, tuple):
+            return util.ReliableSender(self.sock, client_address, self.window)
+        return util.LocalSender(self.local_sock, client_address)
+
+    def make_thread(self, sender, send_queue):
+        '''
+        Create a thread to send the messages queued for a client one after another
+        '''
+        T = threading.Thread(target=self.sender_loop, args=(sender, send_queue))
         T.daemon = True
         T.start()
-    
-    def send_reliable_message(self, msg, client_address):
+
+    def sender_loop(self, sender, send_queue):
+        '''
+        Sends the queued messages of a client until the client is gone and its queue is empty
+        Messages that queue up while a transfer is in progress go out together in the next transfer, streams are sent on their own
+        in segments. The client is followed to the new address if it resumes its session from one
+        '''
+        held = None
+        while True:
+            try:
+                if held is not None:
+                    msg, held = held, None
+                else:
+                    msg = send_queue.get(timeout=util.TIME_OUT)
+            except queue.Empty:
+                client_address = sender.address
+                with self.send_lock:
+                    # Stop once the queue is replaced or the client left and there is nothing more to send
+                    if self.send_queues.get(client_address) is not send_queue:
+                        return
+                    if client_address not in self.clients and client_address not in self.peers and send_queue.empty():
+                        del self.send_queues[client_address]
+                        del self.senders[client_address]
+                        return
+                continue
+            client_address = sender.address
+            if self.send_queues.get(client_address) is not send_queue:
+                return
+            if not isinstance(msg, str):
+                self.send_stream(msg, sender, send_queue)
+                continue
+            batch = [msg]
+            while len(batch) < util.MAX_BATCH:
+                try:
+                    msg = send_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if not isinstance(msg, str):
+                    held = msg
+                    break
+                batch.append(msg)
+            self.send_reliable_message(' '.join(batch), client_address)
+
+    def send_reliable_message(self, msg, client_address, header=""):
         '''
         This function splits the message into chunks and sends them with reliability
+        msg can also be the chunks of a stream, which are sent behind its header
+        Returns whether the client received the message
         '''
-        # Generate a random sequence number for the start packet
-        seq_num = random.randint(1, 1000000)
-        start_seq_num = seq_num
-        
-        # Calculate number of chunks needed
-        x_var = sys.getsizeof(msg)
-        num_of_packets = math.ceil(x_var / util.CHUNK_SIZE)
-        chunk_size = math.ceil(len(msg) / num_of_packets)
-        
-        # Split message into chunks
-        chunks = [msg[i:i+chunk_size] for i in range(0, len(msg), chunk_size)]
-        
-        # Calculate last sequence number
-        num_of_data_packets = len(chunks)
-        last_seq_num = start_seq_num + num_of_data_packets + 2
-        
-        # Reset acknowledgment tracking for this client
-        self.ack_gotten[client_address] = -1
-        self.ack_num_next[client_address] = -1
-        
-        # Send START packet and wait for acknowledgment
-        start_packet = util.make_packet('start', seq_num)
-        self.sock.sendto(start_packet.encode('utf-8'), client_address)
-        self.packet_times[client_address] = datetime.datetime.now()
-        
-        # Keep retransmitting START until ACK received
-        self.start_end_transmission(client_address, start_seq_num + 1, start_packet)
-        # Update ack tracking
-        self.ack_gotten[client_address] = self.ack_num_next[client_address]
-        self.ack_num_next[client_address] = -1
-        
-        # Send all data chunks with reliability
-        self.data_transmission(client_address, last_seq_num, start_seq_num, chunks)
-        
-        # Send END packet and wait for acknowledgment
-        end_packet = util.make_packet("end", last_seq_num - 1)
-        self.sock.sendto(end_packet.encode('utf-8'), client_address)
-        self.packet_times[client_address] = datetime.datetime.now()
-        
-        # Keep retransmitting END until ACK received
-        self.start_end_transmission(client_address, last_seq_num, end_packet)
-        # Reset acknowledgment state
-        self.ack_num_next[client_address] = -1
-        self.ack_gotten[client_address] = -1
-    
-    def start_end_transmission(self, client_address, seq, msg_packet):
+        sender = self.senders.get(client_address)
+        if isinstance(msg, str):
+            sent = sender is not None and sender.send(util.make_chunks(msg))
+        else:
+            sent = sender is not None and sender.send(msg, header)
+        if not sent:
+            print("failed to deliver message to", self.clients.get(client_address, client_address))
+            if client_address in self.peers:
+                self.node_lost(client_address)
+        return sent
+
+    def send_stream(self, stream, sender, send_queue):
         '''
-        Handles reliable transmission of START/END packet with retransmission
+        Sends the next segment of a relayed stream and puts the stream back in the queue until it is finished,
+        so that the queued messages of higher classes go out between its segments.
+        A segment cut short because the client resumed its session from a new address is put back and sent there,
+        the client tells how much of it already arrived. A client that stopped answering or lost part of the file
+        gets file_incomplete instead
         '''
-        ack_control = False
-        while True:
-            if self.ack_num_next.get(client_address) == seq:
-                break
+        client_address = sender.address
+        segment = stream.segment()
+        if segment is not None:
+            sent = self.send_reliable_message(segment, client_address, stream.header)
+            if not sent and sender.address != client_address:
+                stream.unread(segment)
+            elif not sent or getattr(segment, 'gap', False):
+                stream.abandon()
+        if not stream.finished:
+            send_queue.requeue(stream, util.PRIORITY_BULK)
+        elif (not stream.closed or stream.abandoned) and stream.segments:
+            # The file stopped short, the recipient should not wait for the rest of it
+            sender_name, _, transfer_id, _ = util.parse_message(stream.header).split_body(3)
+            send_queue.requeue(util.make_message('file_incomplete', 4, "%s %s" % (sender_name, transfer_id)),
+                               util.PRIORITY_CONTROL)
 
-            if ack_control:
-                ack_control = False
+    def send_window_update(self, client_address):
+        '''
+        Re-sends the current ACK of a client's transfer so that it learns its window has opened up again
+        '''
+        receiver = self.receivers.get(client_address)
+        if isinstance(receiver, util.ReliableReceiver) and receiver.expected is not None:
+            self.sock.sendto(util.make_ack(receiver.expected, receiver.advertised_window()), client_address)
+        elif isinstance(receiver, util.LocalReceiver):
+            try:
+                self.local_wakeup_writer.send(b'x')
+            except OSError:
+                # local_loop has not read the earlier wakeups yet, it drains every receiver anyway
+                pass
 
-            if (datetime.datetime.now() - self.packet_times.get(client_address)) > datetime.timedelta(seconds=0.5):
-                ack_control = True
-                self.sock.sendto(msg_packet.encode('utf-8'), client_address)
-                self.packet_times[client_address] = datetime.datetime.now()
+    def open_relay(self, header, client_address):
+        '''
+        Called when a client starts streaming a file, the header is `file <length> <recipient> <size> <transfer id> <name>`
+        Returns the RelayStream that passes the file on to the recipient chunk by chunk, or None to discard it
+        A transfer that was interrupted continues on the relay it had, after the chunks already received
+        '''
+        message = util.parse_message(header)
+        if message is None or message.type != 'file':
+            return None
+        parts = message.split_body(3)
+        if len(parts) < 4:
+            return None
+        recipient, size, transfer_id, name = parts
+        # Forget the relays that have ended
+        self.transfers = {key: relay for key, relay in self.transfers.items() if not relay.finished}
+        # A client resumes its files once its session is confirmed, so it is known here by then
+        sender_name = self.clients.get(client_address)
+        relay = self.transfers.get((sender_name, transfer_id))
+        if relay is not None and not relay.closed:
+            print("file:", sender_name, "to", recipient, "resumed after", relay.received, "chunks")
+            relay.on_space = lambda: self.send_window_update(client_address)
+            relay.limiter = self.rate_limiter(client_address)
+            return relay
+        # The join of a new client may still be waiting for its dispatch worker, so the sender and the recipient are looked up there.
+        # Until then the relay takes no chunks and the uploader is told to wait by a zero window
+        relay = util.RelayStream(None, lambda: self.send_window_update(client_address))
+        # The file counts against the uploader's byte rate like its messages do
+        relay.limiter = self.rate_limiter(client_address)
+        self.hand_off(lambda: self.start_relay(relay, client_address, recipient, size, transfer_id, name), client_address)
+        return relay
 
-    def data_transmission(self, client_address, last_seq_num, start_seq_num, chunks):
+    def start_relay(self, relay, client_address, recipient, size, transfer_id, name):
         '''
-        Handles reliable transmission of DATA packets with retransmission
+        Runs on the uploader's dispatch worker after the messages it sent before the file.
+        Queues the relay for the recipient. If the sender is not joined or the recipient is unknown the relay is rejected
+        before any of the file is sent, the uploader is told with err_file_rejected to give up the transfer
         '''
-        while self.ack_gotten[client_address] != last_seq_num - 1:
-            i = self.ack_gotten[client_address] - start_seq_num - 1
-            packet = util.make_packet("data", self.ack_gotten[client_address], chunks[i])
-            self.sock.sendto(packet.encode('utf-8'), client_address)
-            self.packet_times[client_address] = datetime.datetime.now()
-            self.data_retransmission(client_address)
-    
-    def data_retransmission(self, client_address):
+        sender_name = self.clients.get(client_address)
+        user_address = self.find_user(recipient) if sender_name is not None else None
+        if user_address is None:
+            print("file:", sender_name, "to non-existent user", recipient)
+            relay.reject()
+            self.send_message('err_file_rejected', 1, transfer_id, client_address)
+            return
+        print("file:", sender_name, "to", recipient)
+        self.transfers[(sender_name, transfer_id)] = relay
+        relay.start(util.make_message('file', 4, "%s %s %s %s" % (sender_name, size, transfer_id, name)))
+        self.enqueue_message(relay, user_address, util.PRIORITY_BULK)
+
+    def resume_session(self, old_address, client_address):
         '''
-        Handles retransmission of data packets if ACK not received in time
+        Moves the session of a client from its old address to the one it resumed from.
+        Messages queued for it are sent to the new address, the transfer in progress starts over there
         '''
-        while not (datetime.datetime.now() - self.packet_times.get(client_address)) > datetime.timedelta(seconds=0.5):
-            if self.ack_num_next.get(client_address) == self.ack_gotten[client_address] + 1:
-                self.ack_gotten[client_address] = self.ack_gotten[client_address] + 1
-                self.ack_num_next[client_address] = -1
-                break
-    
+        with self.send_lock:
+            self.clients[client_address] = self.clients.pop(old_address)
+            # Anything sent to the new address before the session was resumed is replaced
+            self.send_queues.pop(client_address, None)
+            self.senders.pop(client_address, None)
+            if old_address in self.send_queues and isinstance(old_address, tuple) != isinstance(client_address, tuple):
+                # The client switched between UDP and the Unix socket, its old sender can not reach it there
+                self.send_queues.pop(old_address)
+                self.senders.pop(old_address)
+            elif old_address in self.send_queues:
+                self.send_queues[client_address] = self.send_queues.pop(old_address)
+                sender = self.senders.pop(old_address)
+                self.senders[client_address] = sender
+                sender.rebind(client_address)
+        # The stream the client was sending stays open on its relay until it is resumed
+        self.receivers.pop(old_address, None)
+        # Coming back from another address does not refill the client's token buckets
+        if old_address in self.rate_limiters:
+            self.rate_limiters[client_address] = self.rate_limiters.pop(old_address)
+        if old_address in self.capabilities:
+            self.capabilities[client_address] = self.capabilities.pop(old_address)
+        with self.presence_lock:
+            if old_address in self.subscribers:
+                self.subscribers.discard(old_address)
+                self.subscribers.add(client_address)
+
+    def local_users(self):
+        '''
+        Returns the users connected to this node as the body of a node_join or node_presence message,
+        after the cluster key or `-` if there is none
+        '''
+        return ' '.join([self.cluster_key or '-'] + sorted(self.clients.values()))
+
+    def trusted_node(self, node_address, key):
+        '''
+        Returns whether a node may peer with us: it is a peer or a known node already, or it sent our cluster key
+        '''
+        if node_address in self.peers or node_address in self.known_nodes:
+            return True
+        if self.cluster_key is None or not secrets.compare_digest(key, self.cluster_key):
+            return False
+        with self.node_lock:
+            self.known_nodes.add(node_address)
+        return True
+
+    def find_user(self, username):
+        '''
+        Returns the address of a user connected to this node, or None
+        '''
+        return next((addr for addr, name in list(self.clients.items()) if name == username), None)
+
+    def set_peer_users(self, node_address, users):
+        '''
+        Records the users connected to a peer node and rebuilds the routing table from the users of every peer
+        '''
+        users = set(users)
+        with self.node_lock:
+            old_users = self.peers.get(node_address, set())
+            self.peers[node_address] = users
+            self.routes = {user: addr for addr, peer_users in self.peers.items() for user in peer_users}
+        self.publish_presence(users - old_users, old_users - users)
+
+    def node_lost(self, node_address):
+        '''
+        Forgets a peer node that stopped answering together with its users, the heartbeat tries to reach it again if it is a seed
+        '''
+        with self.node_lock:
+            users = self.peers.pop(node_address, None)
+            if users is None:
+                return
+            self.routes = {user: addr for addr, peer_users in self.peers.items() for user in peer_users}
+        print("node left:", util.format_address(node_address))
+        self.publish_presence(left=users)
+
+    def publish_presence(self, joined=(), left=()):
+        '''
+        Sends the users that joined or left the cluster to the subscribed clients.
+        The body is `<version> +<user> ... -<user> ...`, every update gets the next version.
+        The updates are queued after presence_lock is released, since a full queue can block or disconnect the subscriber,
+        so concurrent updates may reach a client out of order: it then sees a gap and asks for a snapshot
+        '''
+        if not joined and not left:
+            return
+        changes = ['+' + user for user in sorted(joined)] + ['-' + user for user in sorted(left)]
+        with self.presence_lock:
+            self.presence_version += 1
+            body = "%d %s" % (self.presence_version, ' '.join(changes))
+            subscribers = list(self.subscribers)
+        for client_address in subscribers:
+            self.send_message('presence_update', 3, body, client_address)
+
+    def announce_presence(self):
+        '''
+        Sends the users connected to this node to every peer node.
+        Each update lists all of them, so the peers converge on the latest one even after missing some
+        '''
+        users = self.local_users()
+        for node_address in list(self.peers):
+            self.send_message('node_presence', 3, users, node_address)
+
+    def heartbeat(self):
+        '''
+        Periodically sends the presence of this node to its peers and asks the seeds it is not peered with to join,
+        and forgets the rate limiters of addresses that never joined.
+        A peer whose transfers fail is dropped by node_lost(), this is what notices peers that left without saying so
+        '''
+        while True:
+            self.forget_rate_limiters()
+            for node_address in set(self.seeds) | set(self.peers):
+                # A peer that is still busy with the previous update does not need another one
+                send_queue = self.send_queues.get(node_address)
+                if send_queue is not None and not send_queue.empty():
+                    continue
+                if node_address in self.peers:
+                    self.send_message('node_presence', 3, self.local_users(), node_address)
+                elif node_address != self.address:
+                    self.send_message('node_join', 3, self.local_users(), node_address)
+            time.sleep(util.NODE_HEARTBEAT)
+
+    def disconnect_slow_client(self, client_address):
+        '''
+        Disconnects a client that does not keep up with the messages sent to it and drops everything queued for it
+        '''
+        with self.send_lock:
+            self.send_queues.pop(client_address, None)
+            self.senders.pop(client_address, None)
+        with self.presence_lock:
+            self.subscribers.discard(client_address)
+        if client_address in self.clients:
+            username = self.clients.pop(client_address)
+            self.sessions.pop(username, None)
+            print("disconnected:", username, "too slow")
+            self.announce_presence()
+            self.publish_presence(left=[username])
+        self.receivers.pop(client_address, None)
+        self.rate_limiters.pop(client_address, None)
+        self.capabilities.pop(client_address, None)
+
     def client_handler(self, message_packet, client_addr):
         '''
         Handle incoming packets from clients
         '''
+        span = util.trace_begin('client_handler')
+        # Drop corrupted packets before they reach the reassembly or get acknowledged
+        if not util.verify_packet(message_packet):
+            self.corrupt_packets += 1
+            return " "
         # Decode the packet and extract info
         message_decoded = message_packet.decode('utf-8')
         msg_type, seq_num, recv_msg, _ = util.parse_packet(message_decoded)
         seq_num = int(seq_num)
-        end_recv = False
-        recv_msg_result = " "
-        
-        # Handle different packet types
+        if span:
+            span.mark('parse')
+            span.info = msg_type
+
         if msg_type == 'ack':
-            # Update next expected sequence number
-            self.ack_num_next[client_addr] = seq_num
-            
-        elif msg_type == 'start':
-            # Initialize a new message reception
-            if client_addr not in self.client_messages:
-                self.client_messages[client_addr] = queue.Queue()
-            msg_queue = queue.Queue()
-            self.client_messages[client_addr] = msg_queue
-            # Set next expected sequence number
-            self.expected_seq[client_addr] = seq_num + 1
-            seq_num_send = self.expected_seq[client_addr]
-            # Send acknowledgment
-            msg = util.make_message('ack', 2,)
-            msg = util.make_packet('ack', int(seq_num_send), msg)
-            self.sock.sendto(msg.encode("utf-8"), client_addr)   
-            
-        elif msg_type == 'data':
-            # Check if sequence number matches expected
-            if client_addr in self.expected_seq and self.expected_seq[client_addr] == seq_num:
-                # Add to message queue
-                self.client_messages[client_addr].put(message_packet)
-                # Update next expected sequence number
-                self.expected_seq[client_addr] = seq_num + 1
-            # Send acknowledgment for the received packet
-            msg = util.make_message('ack', 2,)
-            msg = util.make_packet('ack', int(self.expected_seq.get(client_addr, seq_num + 1)), msg)
-            self.sock.sendto(msg.encode("utf-8"), client_addr)
-            
-        elif msg_type == 'end':
-            # Process the complete message if all packets received
-            if client_addr in self.expected_seq and self.expected_seq[client_addr] == seq_num:
-                # Combine all received message chunks
-                recv_msg_result = ''
-                while not self.client_messages[client_addr].empty():
-                    msg_type, _, str_msg, _ = util.parse_packet(self.client_messages[client_addr].get().decode('utf-8'))
-                    recv_msg_result += str_msg
-                
-                # Send acknowledgment for END packet
-                seq_num_next = self.expected_seq[client_addr] + 1
-                msg = util.make_message('ack', 2,)
-                msg = util.make_packet('ack', int(seq_num_next), msg)
-                self.sock.sendto(msg.encode("utf-8"), client_addr) 
-                
-                # Clean up client state
-                if client_addr in self.expected_seq:
-                    del self.expected_seq[client_addr]
-                
-                end_recv = True
-            else:
-                # Send acknowledgment for the current expected sequence
-                msg = util.make_message('ack', 2,)
-                msg = util.make_packet('ack', int(self.expected_seq.get(client_addr, seq_num)), msg)
-                self.sock.sendto(msg.encode("utf-8"), client_addr) 
-        if end_recv:
+            # Hand the ACK to the thread sending to this client
+            sender = self.senders.get(client_addr)
+            if sender is not None:
+                sender.on_ack(seq_num, *util.parse_ack(recv_msg))
+            util.trace_end(span)
+            return " "
+
+        if util.is_datagram(msg_type, seq_num):
+            # A message of the datagram delivery class, complete on its own and never acknowledged
+            util.trace_end(span)
+            return recv_msg
+
+        receiver = self.receivers.get(client_addr)
+        if receiver is None:
+            receiver = util.ReliableReceiver(self.window, lambda header: self.open_relay(header, client_addr))
+            self.receivers[client_addr] = receiver
+        ack_num, recv_msg_result = receiver.on_packet(msg_type, seq_num, recv_msg)
+        if ack_num is None:
+            # The ACK waits for the next packet, or is sent by send_delayed_acks()
+            self.delayed_acks[client_addr] = receiver
+        else:
+            # Send acknowledgment for the received packet, telling the client where to resume a stream it had started before
+            offset = receiver.resume_offset if msg_type == 'start' else 0
+            self.sock.sendto(util.make_ack(ack_num, receiver.advertised_window(), offset), client_addr)
+        if span:
+            span.mark('ack_sent')
+            if recv_msg_result is not None:
+                span.mark('transfer_complete')
+            util.trace_end(span)
+        if recv_msg_result is not None:
             return recv_msg_result
         else:
             return " "
     
+    def send_delayed_acks(self):
+        '''
+        Sends the delayed ACKs that are due.
+        Returns the time until the next one is due, or None if no ACK is being delayed
+        '''
+        next_due = None
+        for client_address, receiver in list(self.delayed_acks.items()):
+            if receiver.ack_deadline is None:
+                del self.delayed_acks[client_address]
+                continue
+            ack_num = receiver.delayed_ack()
+            if ack_num is not None:
+                del self.delayed_acks[client_address]
+                self.sock.sendto(util.make_ack(ack_num, receiver.advertised_window()), client_address)
+            else:
+                wait = max(0, receiver.ack_deadline - time.monotonic())
+                next_due = wait if next_due is None else min(next_due, wait)
+        return next_due
+
     def unknown_error(self, clientaddress):
         '''
         This function is used to handle unknown errors and send an error message to the client
         '''
         print("disconnected:", self.clients[clientaddress], "sent unknown command")
-        self.clients.pop(clientaddress)
+        username = self.clients.pop(clientaddress)
+        self.sessions.pop(username, None)
+        with self.presence_lock:
+            self.subscribers.discard(clientaddress)
         self.send_message('err_unknown_message', 2, "", clientaddress)
+        self.capabilities.pop(clientaddress, None)
+        self.announce_presence()
+        self.publish_presence(left=[username])
+
+    def handle_join(self, message, client_address):
+        '''
+        Adds the client to the list of connected clients unless the server is full or the username is taken.
+        The body is `<username> <delivery class> ...`, with the delivery classes the client accepts.
+        A client that announces none takes what it joined with: client_1 only sends and understands datagrams
+        '''
+        parts = message.split_body()
+        username = parts[0]
+        capabilities = set(parts[1:]) & set(util.CAPABILITIES) or {message.delivery}
+        with self.clients_lock:
+            # Check if server is full
+            if len(self.clients) >= util.MAX_NUM_CLIENTS:
+                error = 'err_server_full'
+            # Check if username is already taken, on this node or another one of the cluster
+            elif username in self.clients.values() or username in self.routes:
+                error = 'err_username_unavailable'
+            else:
+                # Add client to the list of connected clients and give it the token to resume its session with
+                error = None
+                # A client that joins again keeps the delivery classes it first joined with
+                if client_address not in self.clients:
+                    self.capabilities[client_address] = capabilities
+                self.clients[client_address] = username
+                self.sessions[username] = secrets.token_hex(16)
+        # Even a rejection is sent the way the client understands
+        if error == 'err_server_full':
+            self.send_message('err_server_full', 2, "", client_address, capabilities)
+            print('disconnected: server full')
+        elif error == 'err_username_unavailable':
+            self.send_message('err_username_unavailable', 2, "", client_address, capabilities)
+            print('disconnected: username not available')
+        else:
+            print("join:", username)
+            # Sessions and capabilities mean nothing to a client that can not receive reliable messages
+            if util.DELIVERY_RELIABLE in self.capabilities.get(client_address, capabilities):
+                self.send_message('session', 1, self.sessions[username], client_address)
+                self.send_message('capabilities', 3, ' '.join(util.CAPABILITIES), client_address)
+            self.announce_presence()
+            self.publish_presence(joined=[username])
+
+    def handle_resume(self, message, client_address):
+        '''
+        Lets a client that comes back, possibly from a new address, take over its session.
+        The body is `<username> <session token>`, a token that does not match makes the client join again
+        '''
+        parts = message.split_body(1)
+        if len(parts) < 2 or parts[0] not in self.sessions or not secrets.compare_digest(self.sessions[parts[0]], parts[1]):
+            self.send_message('err_session_invalid', 2, "", client_address)
+            print('resume: invalid session')
+            return
+        username, token = parts
+        with self.clients_lock:
+            old_address = self.find_user(username)
+            if old_address is not None and old_address != client_address:
+                self.resume_session(old_address, client_address)
+        print("resume:", username)
+        self.send_message('session', 1, token, client_address)
+        self.send_message('capabilities', 3, ' '.join(util.CAPABILITIES), client_address)
+
+    def handle_request_users_list(self, message, client_address):
+        '''
+        Sends the sorted list of the users connected to the cluster to the client
+        '''
+        username = self.clients[client_address]
+        print("request_users_list:", username)
+        userlist = list(self.clients.values()) + list(self.routes)
+        userlist = sorted(userlist)
+        resp = ' '.join(userlist)
+        self.send_message('response_users_list', 3, resp, client_address)
+
+    def handle_subscribe_presence(self, message, client_address):
+        '''
+        Subscribes the client to presence updates and sends it a snapshot of the users connected to the cluster.
+        The body of the snapshot is `<version> <user1> <user2> ...`, the updates that follow continue from its version.
+        A subscribed client subscribes again to get a new snapshot when it misses an update
+        '''
+        print("subscribe_presence:", self.clients[client_address])
+        with self.presence_lock:
+            self.subscribers.add(client_address)
+            userlist = sorted(list(self.clients.values()) + list(self.routes))
+            body = "%d %s" % (self.presence_version, ' '.join(userlist))
+        # Updates queued before the snapshot are kept by the client until the snapshot arrives
+        self.send_message('presence_snapshot', 3, body, client_address)
+
+    def handle_unsubscribe_presence(self, message, client_address):
+        '''
+        Stops sending presence updates to the client
+        '''
+        with self.presence_lock:
+            self.subscribers.discard(client_address)
+
+    def handle_typing(self, message, client_address):
+        '''
+        Tells the users a client is typing to, the body is `<number of users> <user1> ...`.
+        Only users of this node that accept datagrams are told, a lost indicator is simply not shown
+        '''
+        recipients = util.split_recipients(message.body)
+        if recipients is None:
+            return
+        username = self.clients[client_address]
+        for user in recipients[0]:
+            user_address = self.find_user(user)
+            if user_address is not None and util.DELIVERY_DATAGRAM in self.capabilities.get(user_address, ()):
+                self.send_message('forward_typing', 3, username, user_address)
+
+    def handle_send_message(self, message, client_address):
+        '''
+        Forwards the message to each of the users it is addressed to.
+        The body is `<number of users> <user1> ... <message content>`, the content is forwarded without being split up.
+        Users connected to other nodes get the message through their node, once per node
+        '''
+        print("msg:", self.clients[client_address])
+        # Check if message format is valid
+        recipients = util.split_recipients(message.body)
+        if recipients is None:
+            self.unknown_error(client_address)
+            return
+
+        user_list, message_content = recipients
+        username = self.clients[client_address]
+        forward = username + ' ' + message_content
+
+        # Send message to each specified user
+        remote = {}
+        for user in user_list:
+            user_address = self.find_user(user)
+            if user_address is not None:
+                self.send_message('forward_message', 4, forward, user_address)
+            elif user in self.routes:
+                remote.setdefault(self.routes[user], []).append(user)
+            else:
+                print("msg:", username, "to non-existent user", user)
+        for node_address, users in remote.items():
+            body = "%s %d %s %s" % (username, len(users), ' '.join(users), message_content)
+            self.send_message('node_forward', 4, body, node_address)
+
+    def handle_disconnect(self, message, client_address):
+        '''
+        Removes the client from the list of connected clients
+        '''
+        print('disconnected:', self.clients[client_address])
+        username = self.clients.pop(client_address)
+        self.sessions.pop(username, None)
+        self.receivers.pop(client_address, None)
+        self.rate_limiters.pop(client_address, None)
+        self.capabilities.pop(client_address, None)
+        with self.presence_lock:
+            self.subscribers.discard(client_address)
+        self.announce_presence()
+        self.publish_presence(left=[username])
+
+    def handle_node_join(self, message, node_address):
+        '''
+        Another server node peers with us, the body is the cluster key followed by the users connected to it.
+        It is answered with our users and the other peers, and a new node is named to the other peers,
+        so that it and they know each other and join as well.
+        A node that is neither known nor sends the cluster key is refused, it could otherwise take over any username
+        '''
+        key, *users = message.split_body() or ['']
+        if not self.trusted_node(node_address, key):
+            print("node refused:", util.format_address(node_address))
+            return
+        joined = node_address not in self.peers
+        if joined:
+            print("node joined:", util.format_address(node_address))
+        self.set_peer_users(node_address, users)
+        self.send_message('node_presence', 3, self.local_users(), node_address)
+        others = [addr for addr in self.peers if addr != node_address]
+        if others:
+            self.send_message('node_peers', 3, ' '.join(util.format_address(addr) for addr in others), node_address)
+        if joined:
+            for peer_address in others:
+                self.send_message('node_peers', 3, util.format_address(node_address), peer_address)
+
+    def handle_node_presence(self, message, node_address):
+        '''
+        Updates the users connected to a peer node, a node we are not peered with yet is treated as joining
+        '''
+        if node_address not in self.peers:
+            self.handle_node_join(message, node_address)
+        else:
+            self.set_peer_users(node_address, message.split_body()[1:])
+
+    def handle_node_peers(self, message, node_address):
+        '''
+        Joins the nodes a peer is peered with that we do not know yet, they become known nodes that may peer with us
+        '''
+        if node_address not in self.peers:
+            return
+        for peer in message.split_body():
+            peer_address = util.parse_address(peer)
+            if peer_address is not None and peer_address != self.address and peer_address not in self.peers:
+                with self.node_lock:
+                    self.known_nodes.add(peer_address)
+                self.send_message('node_join', 3, self.local_users(), peer_address)
+
+    def handle_node_forward(self, message, node_address):
+        '''
+        Delivers a message from a user of a peer node to the users of this node it is addressed to.
+        The body is `<sender> <number of users> <user1> ... <message content>`
+        '''
+        if node_address not in self.peers:
+            return
+        sender, _, rest = message.body.partition(' ')
+        recipients = util.split_recipients(rest)
+        if recipients is None:
+            return
+        user_list, message_content = recipients
+        for user in user_list:
+            user_address = self.find_user(user)
+            if user_address is not None:
+                self.send_message('forward_message', 4, sender + ' ' + message_content, user_address)
+            else:
+                print("msg:", sender, "to non-existent user", user)
+
+    def handle_unknown(self, message, client_address):
+        '''
+        Handles a message type the server does not know
+        '''
+        self.unknown_error(client_address)
+
+    def admit(self, message, client_address):
+        '''
+        Checks a message against the token buckets of its sender, every address but the peer nodes has them.
+        A message over the limit is dropped, a connected client is told with err_rate_limited the first time in a row it happens.
+        A connected client can always disconnect, joins and resumes come from addresses that are not clients yet and are limited,
+        so that no address can flood the server with them
+        '''
+        if client_address in self.peers or client_address in self.clients and message.type in util.RATE_LIMIT_EXEMPT:
+            return True
+        limiter = self.rate_limiter(client_address)
+        was_limited = limiter.limited
+        if limiter.admit(len(message.body)):
+            return True
+        if not was_limited and client_address in self.clients:
+            print("rate limited:", self.clients[client_address])
+            self.send_message('err_rate_limited', 2, "", client_address)
+        return False
+
+    def rate_limiter(self, client_address):
+        '''
+        Returns the token buckets of an address, creating them the first time it sends something
+        '''
+        limiter = self.rate_limiters.get(client_address)
+        if limiter is None:
+            limiter = util.RateLimiter(self.rate_limit, self.byte_limit, self.burst)
+            self.rate_limiters[client_address] = limiter
+        return limiter
+
+    def forget_rate_limiters(self):
+        '''
+        Drops the token buckets of the addresses that are not clients once they have refilled,
+        so that the joins and resumes of addresses that never became clients do not leave them behind
+        '''
+        for client_address, limiter in list(self.rate_limiters.items()):
+            if client_address not in self.clients and limiter.full():
+                self.rate_limiters.pop(client_address, None)
+
+    def dispatch(self, message, client_address):
+        '''
+        Passes a message to the handler for its type, unless the client is over its rate limit
+        '''
+        span = util.trace_begin('dispatch', message.type)
+        try:
+            if self.admit(message, client_address):
+                handler = self.handlers.get(message.type, self.handle_unknown)
+                handler(message, client_address)
+        except Exception as e:
+            print(f"Error in server: {e}")
+        if span:
+            span.mark('dispatch')
+            util.trace_end(span)
+
+    def hold_local(self, client_address, held):
+        '''
+        Tells a client on the Unix socket to pause what it sends while we hold it back, or to go on, like a zero window does.
+        Sent without waiting, if the client misses `go|` it goes on by itself after RELAY_TIME_OUT
+        '''
+        try:
+            self.local_sock.sendto(b'wait|' if held else b'go|', socket.MSG_DONTWAIT, client_address)
+        except OSError:
+            pass
+
+    def drain_local(self):
+        '''
+        Passes on what the clients on the Unix socket sent while their stream's relay was full, as far as the relays have space now
+        '''
+        for client_address, receiver in list(self.receivers.items()):
+            if isinstance(receiver, util.LocalReceiver) and receiver.held:
+                for recv_msg in receiver.drain():
+                    self.hand_off(recv_msg, client_address, util.DELIVERY_RELIABLE)
+
+    def local_loop(self):
+        '''
+        Receives from the clients connected through the Unix socket.
+        Nothing is lost or reordered there, so complete messages go straight to the dispatch workers, waiting for room if needed.
+        A full relay never holds up this loop, the receiver holds back its client's datagrams instead. They are passed on
+        when the relay wakes us up with space, and checked every TIME_OUT so that a relay that was abandoned lets them through
+        '''
+        next_drain = time.monotonic() + util.TIME_OUT
+        while True:
+            try:
+                ready = select.select([self.local_sock, self.local_wakeup], [], [], util.TIME_OUT)[0]
+                if self.local_wakeup in ready or time.monotonic() >= next_drain:
+                    if self.local_wakeup in ready:
+                        self.local_wakeup.recv(4096)
+                    next_drain = time.monotonic() + util.TIME_OUT
+                    self.drain_local()
+                if self.local_sock not in ready:
+                    continue
+                datagram, client_address = self.local_sock.recvfrom(util.LOCAL_DATAGRAM_SIZE)
+                receiver = self.receivers.get(client_address)
+                if receiver is None:
+                    receiver = util.LocalReceiver(lambda header, client_address=client_address: self.open_relay(header, client_address),
+                                                  resume_streams=True,
+                                                  on_hold=lambda held, client_address=client_address: self.hold_local(client_address, held))
+                    self.receivers[client_address] = receiver
+                recv_msg = receiver.on_datagram(datagram)
+                if recv_msg is not None:
+                    self.hand_off(recv_msg, client_address, util.DELIVERY_RELIABLE)
+            except Exception as e:
+                print(f"Error in server: {e}")
+                continue
+
+    def hand_off(self, item, client_address, delivery=None):
+        '''
+        Passes a complete message from client_address, or a function to run after the ones before it, to the client's dispatch worker,
+        waiting for room in its queue.
+        The receive loop checks for room and keeps dispatch_room while it handles a packet, so it never waits here
+        '''
+        dispatch_queue = self.dispatch_queues[hash(client_address) % len(self.dispatch_queues)]
+        with self.dispatch_room:
+            self.dispatch_room.wait_for(lambda: not dispatch_queue.full())
+            dispatch_queue.put_nowait((item, client_address, delivery))
+
+    def dispatch_loop(self, dispatch_queue):
+        '''
+        Dispatch worker: handles the messages of the transfers the receive loop hands to it, in the order they arrived,
+        and runs the functions handed to it in between, such as start_relay()
+        '''
+        while True:
+            recv_msg, client_address, delivery = dispatch_queue.get()
+            with self.dispatch_room:
+                self.dispatch_room.notify_all()
+            if callable(recv_msg):
+                recv_msg()
+                continue
+            # A transfer can carry several messages, process them in order
+            for message in util.iter_messages(recv_msg):
+                message.delivery = delivery
+                self.dispatch(message, client_address)
 
     def start(self):
         '''
         Main loop.
-        continue receiving messages from Clients and processing it.
+        continue receiving messages from Clients, acknowledging them and passing the complete ones to the dispatch workers.
+        The chat logic runs on the workers, so a slow handler never holds up the ACKs of any client
         '''
+        T = threading.Thread(target=self.heartbeat)
+        T.daemon = True
+        T.start()
+        for dispatch_queue in self.dispatch_queues:
+            T = threading.Thread(target=self.dispatch_loop, args=(dispatch_queue,))
+            T.daemon = True
+            T.start()
+        if self.local_sock is not None:
+            T = threading.Thread(target=self.local_loop)
+            T.daemon = True
+            T.start()
         while True:
             try:
+                # Only wait for the next packet as long as a delayed ACK can wait
+                timeout = self.send_delayed_acks()
+                if timeout is not None and not select.select([self.sock], [], [], timeout)[0]:
+                    continue
                 # Receive message from client
                 message, client_address = self.sock.recvfrom(4096)
-                
-                # Process the message
-                recv_msg = self.client_handler(message, client_address)
-                
-                if recv_msg != " ":
-                    # Split the message to get its type and content
-                    message_parts = recv_msg.split()
-                    if len(message_parts) < 1:
+                dispatch_queue = self.dispatch_queues[hash(client_address) % len(self.dispatch_queues)]
+                # The Unix socket loop also adds to the queues, it waits while this loop holds dispatch_room,
+                # so the room found here is still there when the packet completes a message or opens a relay
+                with self.dispatch_room:
+                    # A client whose worker is behind gets no ACKs until it catches up, it retransmits its packets later
+                    # instead of holding up the packets of everyone else
+                    if dispatch_queue.full() and not message.startswith(b'ack|'):
                         continue
-                        
-                    message_type = message_parts[0]
-                    
-                    # Process message based on its type
-                    if message_type == 'join':
-                        # Check if server is full
-                        if len(self.clients) >= util.MAX_NUM_CLIENTS:
-                            self.send_message('err_server_full', 2, "", client_address)
-                            print('disconnected: server full')
-                        # Check if username is already taken
-                        elif message_parts[2] in self.clients.values():
-                            self.send_message('err_username_unavailable', 2, "", client_address)
-                            print('disconnected: username not available')
-                        else:
-                            # Add client to the list of connected clients
-                            self.clients[client_address] = message_parts[2]
-                            print("join:", message_parts[2])
-                            
-                    elif message_type == 'request_users_list':
-                        # Send list of connected users
-                        username = self.clients[client_address]
-                        print("request_users_list:", username)
-                        userlist = list(self.clients.values())
-                        userlist = sorted(userlist)
-                        resp = ' '.join(userlist)
-                        self.send_message('response_users_list', 3, resp, client_address)
-                        
-                    elif message_type == 'send_message':
-                        # Forward message to specified clients
-                        print("msg:", self.clients[client_address])
-                        
-                        # Check if message format is valid
-                        if len(message_parts) < 2:
-                            self.unknown_error(client_address)
-                            continue
-                        elif message_parts[2] not in ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10']:
-                            self.unknown_error(client_address)
-                            continue
-                            
-                        # Extract message details
-                        num_users = int(message_parts[2])
-                        user_end_index = 3 + num_users
-                        
-                        # Check if number of users matches
-                        if len(message_parts) < user_end_index:
-                            self.unknown_error(client_address)
-                            continue
-                            
-                        user_list = message_parts[3:user_end_index]
-                        message_content = ' '.join(message_parts[user_end_index:])
-                        
-                        # Send message to each specified user
-                        for user in user_list:
-                            if user in self.clients.values():
-                                # Get user's address
-                                user_address = next((addr for addr, name in self.clients.items() if name == user), None)
-                                self.send_message('forward_message', 4, ' '.join([self.clients[client_address], message_content]), user_address)
-                            else:
-                                print("msg:", self.clients[client_address], "to non-existent user", user)
-                                
-                    elif message_type == 'disconnect':
-                        # Remove client from the list of connected clients
-                        print('disconnected:', self.clients[client_address])
-                        self.clients.pop(client_address)
-                        
-                    else:
-                        # Handle unknown message type
-                        self.unknown_error(client_address)
-                        
+
+                    # Process the message
+                    recv_msg = self.client_handler(message, client_address)
+
+                    if recv_msg != " ":
+                        delivery = util.DELIVERY_DATAGRAM if message.startswith(b'data|0|') else util.DELIVERY_RELIABLE
+                        self.hand_off(recv_msg, client_address, delivery)
+
             except Exception as e:
                 print(f"Error in server: {e}")
                 continue
@@ -317,11 +994,23 @@ if __name__ == "__main__":
         print("-p PORT | --port=PORT The server port, defaults to 15000")
         print("-a ADDRESS | --address=ADDRESS The server ip or hostname, defaults to localhost")
         print("-w WINDOW | --window=WINDOW The window size, default is 3")
+        print("-o POLICY | --overflow=POLICY What to do when a client stalled with its send queue full: block, drop_oldest or disconnect, defaults to drop_oldest")
+        print("-q SIZE | --queue=SIZE The number of messages queued per client, defaults to %d" % util.SEND_QUEUE_SIZE)
+        print("-t TRACE_FILE | --trace=TRACE_FILE Record sampled timing spans and write them to TRACE_FILE on exit")
+        print("--trace-rate=RATE The fraction of packets and messages traced, defaults to 0.01")
+        print("-P HOST:PORT | --peer=HOST:PORT Another server node to form a cluster with, can be given several times")
+        print("-K KEY | --cluster-key=KEY The key that lets nodes that are not given with -P join the cluster, every node needs the same one")
+        print("-r RATE | --rate=RATE The messages per second each client may send, 0 for no limit, defaults to %d" % util.RATE_LIMIT_MESSAGES)
+        print("-b RATE | --byte-rate=RATE The message bytes per second each client may send, 0 for no limit, defaults to %d" % util.RATE_LIMIT_BYTES)
+        print("--burst=SECONDS The seconds of its rate a client may send at once, defaults to %g" % util.RATE_LIMIT_BURST)
+        print("-U PATH | --unix=PATH Also accept clients on the same host through a Unix datagram socket at PATH")
+        print("--workers=N The number of threads handling the received messages, defaults to %d" % util.DISPATCH_WORKERS)
         print("-h | --help Print this help")
 
     try:
         OPTS, ARGS = getopt.getopt(sys.argv[1:],
-                                   "p:a:w", ["port=", "address=","window="])
+                                   "p:a:w:o:q:t:P:r:b:U:K:", ["port=", "address=","window=", "overflow=", "queue=", "trace=", "trace-rate=", "peer=",
+                                                              "rate=", "byte-rate=", "burst=", "workers=", "unix=", "cluster-key="])
     except getopt.GetoptError:
         helper()
         exit()
@@ -329,18 +1018,64 @@ if __name__ == "__main__":
     PORT = 15000
     DEST = "localhost"
     WINDOW = 3
+    OVERFLOW = 'drop_oldest'
+    QUEUE_SIZE = util.SEND_QUEUE_SIZE
+    TRACE_FILE = None
+    TRACE_RATE = util.TRACE_SAMPLE_RATE
+    PEERS = []
+    RATE = util.RATE_LIMIT_MESSAGES
+    BYTE_RATE = util.RATE_LIMIT_BYTES
+    BURST = util.RATE_LIMIT_BURST
+    WORKERS = util.DISPATCH_WORKERS
+    UNIX_PATH = None
+    CLUSTER_KEY = None
 
     for o, a in OPTS:
-        if o in ("-p", "--port="):
+        if o in ("-p", "--port"):
             PORT = int(a)
-        elif o in ("-a", "--address="):
+        elif o in ("-a", "--address"):
             DEST = a
-        elif o in ("-w", "--window="):
+        elif o in ("-w", "--window"):
             WINDOW = a
+        elif o in ("-o", "--overflow"):
+            OVERFLOW = a
+        elif o in ("-q", "--queue"):
+            QUEUE_SIZE = int(a)
+        elif o in ("-t", "--trace"):
+            TRACE_FILE = a
+        elif o == "--trace-rate":
+            TRACE_RATE = float(a)
+        elif o in ("-P", "--peer"):
+            PEER = util.parse_address(a)
+            if PEER is None:
+                helper()
+                exit()
+            PEERS.append(PEER)
+        elif o in ("-r", "--rate"):
+            RATE = float(a)
+        elif o in ("-b", "--byte-rate"):
+            BYTE_RATE = float(a)
+        elif o == "--burst":
+            BURST = float(a)
+        elif o == "--workers":
+            WORKERS = int(a)
+        elif o in ("-U", "--unix"):
+            UNIX_PATH = a
+        elif o in ("-K", "--cluster-key"):
+            CLUSTER_KEY = a
+
+    if OVERFLOW not in util.OVERFLOW_POLICIES:
+        helper()
+        exit()
+
+    if TRACE_FILE:
+        util.enable_tracing(TRACE_RATE)
 
-    SERVER = Server(DEST, PORT,WINDOW)
+    SERVER = Server(DEST, PORT,WINDOW, OVERFLOW, QUEUE_SIZE, PEERS, RATE, BYTE_RATE, BURST, WORKERS, UNIX_PATH, CLUSTER_KEY)
     try:
         SERVER.start()
     except (KeyboardInterrupt, SystemExit):
+        if util.TRACER:
+            util.TRACER.export(TRACE_FILE)
         exit()
             
\ No newline at end of file
@@ -1,11 +1,71 @@
 '''
 This file contains basic utility functions that you can use and can also make your helper functions here
 '''
+import base64
 import binascii
+import collections
+import json
+import math
+import mmap
+import os
+import queue
+import random
+import socket
+import sys
+import threading
+import time
 
 MAX_NUM_CLIENTS = 10
 TIME_OUT = 0.5 # 500ms
 CHUNK_SIZE = 1400 # 1400 Bytes
+MAX_TIME_OUT = 2 # retransmission timeout after repeated losses
+MAX_RETRIES = 10 # retransmissions of one packet before the peer is considered gone
+INITIAL_SSTHRESH = 16 # congestion window size, in packets, where slow start ends
+MAX_CWND = 256 # packets the congestion window may grow to, the sender's and the peer's windows limit what is in flight on their own
+DUP_ACK_THRESHOLD = 3 # duplicate ACKs that trigger a fast retransmit
+ACK_EVERY = 2 # in order DATA packets acknowledged together by one ACK, 1 acknowledges every packet
+ACK_DELAY = 0.04 # seconds an ACK may be delayed waiting for the next DATA packet
+SEND_QUEUE_SIZE = 64 # messages queued per client before new ones wait for room
+STALL_TIME_OUT = 5 # seconds a client with a full send queue may go without acknowledging anything before the overflow policy applies
+MAX_BATCH = 32 # queued messages sent together in a single transfer
+DISPATCH_WORKERS = 4 # threads running the chat logic of the server, messages of one client are always handled by the same one
+DISPATCH_QUEUE_SIZE = 1024 # received transfers waiting for each dispatch worker before the receive loop waits for room
+PRIORITY_CONTROL = 0 # replies and errors
+PRIORITY_INTERACTIVE = 1 # chat messages
+PRIORITY_BULK = 2 # file transfers
+PRIORITY_WEIGHTS = [8, 4, 1] # queued items of each priority class sent per round, so that lower classes are never starved
+# Priority class of the message types a server sends, types not listed are control messages
+MESSAGE_PRIORITIES = {'forward_message': PRIORITY_INTERACTIVE, 'node_forward': PRIORITY_INTERACTIVE}
+RATE_LIMIT_MESSAGES = 100 # messages per second a client may send on average, 0 disables the limit
+RATE_LIMIT_BYTES = 256 * 1024 # message bytes per second a client may send on average, 0 disables the limit
+RATE_LIMIT_BURST = 2 # seconds of the average rate a client may send at once after being idle
+RATE_LIMIT_EXEMPT = ['disconnect'] # messages a connected client is never rate limited for
+FILE_CHUNK_SIZE = 1024 # bytes of a file per DATA packet, base64 encoding makes that 1368 characters
+COMPLETED_TRANSFERS = 64 # recently completed transfers a receiver remembers per peer
+COMPLETED_TIME_OUT = 60 # seconds a completed transfer is remembered
+DELIVERY_RELIABLE = 'reliable' # a message sent as a transfer of its own or batched with others, see ReliableSender
+DELIVERY_DATAGRAM = 'datagram' # a message sent as a single DATA packet with sequence number 0, never acknowledged or retransmitted
+CAPABILITIES = [DELIVERY_RELIABLE, DELIVERY_DATAGRAM] # delivery classes announced at join
+# Messages that may be lost without harm, sent as datagrams to peers that accept them, everything else is reliable.
+# Presence updates stay reliable, the client answers list from them and a lost last update would never be noticed
+MESSAGE_DELIVERY = {'typing': DELIVERY_DATAGRAM, 'forward_typing': DELIVERY_DATAGRAM}
+MAX_PACKET_SIZE = 4096 # bytes read per packet, a datagram message has to fit in one
+RELAY_BUFFER = 16 # chunks of a stream the server holds while relaying it
+RELAY_SEGMENT = 256 # chunks of a relayed stream sent in one transfer before other queued messages get their turn
+RELAY_TIME_OUT = 30 # seconds a relayed stream may stall before it is abandoned, long enough for its sender to reconnect and resume it
+NODE_HEARTBEAT = 5 # seconds between the presence updates a server sends to its peer nodes
+LOCAL_DATAGRAM_SIZE = 65536 # largest datagram sent over a Unix socket, longer messages are sent in chunks
+DOWNLOAD_DIR = 'downloads' # where clients save received files
+OVERFLOW_POLICIES = ['block', 'drop_oldest', 'disconnect']
+TRACE_BUFFER_SIZE = 10000 # spans kept in the trace ring buffer
+TRACE_SAMPLE_RATE = 0.01 # 1% of hook invocations are timed
+
+# The active Tracer, or None when tracing is disabled
+TRACER = None
+# ACK packets are built from the checksum of their fixed prefix and a cached tail for each advertised window
+ACK_PREFIX = b'ack|'
+ACK_PREFIX_CHECKSUM = binascii.crc32(ACK_PREFIX)
+ACK_TAILS = {}
 
 def validate_checksum(message):
     '''
@@ -40,6 +100,26 @@ def make_packet(msg_type="data", seqno=0, msg=""):
     return packet
 
 
+def encode_packet(msg_type="data", seqno=0, msg=""):
+    '''
+    Same as make_packet() but returns the packet as bytes, the checksum is computed on the encoded header and body so nothing is encoded twice
+    '''
+    body = ("%s|%d|%s|" % (msg_type, seqno, msg)).encode('utf-8')
+    return b"%s%d" % (body, binascii.crc32(body))
+
+
+def verify_packet(packet):
+    '''
+    Validates the checksum of a received packet directly on its bytes, without decoding it.
+    Returns true/false
+    '''
+    separator = packet.rfind(b'|')
+    checksum = packet[separator + 1:]
+    if separator == -1 or not checksum.isdigit():
+        return False
+    return binascii.crc32(memoryview(packet)[:separator + 1]) == int(checksum)
+
+
 def parse_packet(message):
     '''
     This function will parse the packet in the same way it was made in the above function.
@@ -67,26 +147,1363 @@ def make_message(msg_type, msg_format, message=None):
         return "%s %d %s" % (msg_type, msg_len, message)
     return ""
 
+def make_datagram(msg):
+    '''
+    Returns the packet that carries msg as a single datagram, the format server_1 and client_1 use for every message.
+    Reliable transfers never use sequence number 0, so the receiver tells the two apart
+    '''
+    return encode_packet('data', 0, msg)
+
+
+def is_datagram(msg_type, seq_num):
+    '''
+    Returns whether a packet is a datagram made by make_datagram() rather than part of a reliable transfer
+    '''
+    return msg_type == 'data' and seq_num == 0
+
+
+def make_ack(seqno, window, offset=0):
+    '''
+    Returns the encoded ACK packet for seqno, advertising how many more DATA packets the receiver can buffer
+    A START packet of a stream the receiver already holds part of is answered with the number of chunks it holds as offset
+    '''
+    tail = ACK_TAILS.get(window) if not offset else None
+    if tail is None:
+        body = "%d %d" % (window, offset) if offset else str(window)
+        tail = ("|%s|" % make_message('ack', 3, body)).encode('utf-8')
+        if not offset:
+            ACK_TAILS[window] = tail
+    packet = b"%d%s" % (seqno, tail)
+    return b"%s%s%d" % (ACK_PREFIX, packet, binascii.crc32(packet, ACK_PREFIX_CHECKSUM))
+
+
+def parse_ack(msg):
+    '''
+    Returns the window and the offset in the body of an ACK packet,
+    the window is None if the peer did not advertise one and the offset is 0 if it sent none
+    '''
+    message = parse_message(msg)
+    if message is None or not message.length:
+        return None, 0
+    fields = message.split_body()
+    if not fields or not all(field.isdigit() for field in fields):
+        return None, 0
+    return int(fields[0]), int(fields[1]) if len(fields) > 1 else 0
+
+
+def parse_address(text):
+    '''
+    Returns the (ip, port) address for a `host:port` string, or None if it is not one
+    '''
+    host, _, port = text.rpartition(':')
+    if not host or not port.isdigit():
+        return None
+    try:
+        return socket.gethostbyname(host), int(port)
+    except OSError:
+        return None
+
+
+def format_address(address):
+    '''
+    Returns the `host:port` string for an (ip, port) address
+    '''
+    return "%s:%d" % address
+
+
+def split_recipients(text):
+    '''
+    Splits `<number of users> <user1> ... <message content>` into the list of users and the content,
+    the content is returned without being split up. Returns None if the text is not in that form
+    '''
+    parts = text.split(None, 1)
+    if len(parts) < 1 or parts[0] not in ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10']:
+        return None
+    num_users = int(parts[0])
+    rest = parts[1].split(None, num_users) if len(parts) > 1 else []
+    if len(rest) < num_users:
+        return None
+    return rest[:num_users], rest[num_users] if len(rest) > num_users else ''
+
+
+def make_chunks(msg):
+    '''
+    Splits a message into the pieces carried by the DATA packets of one transfer
+    '''
+    num_of_packets = math.ceil(sys.getsizeof(msg) / CHUNK_SIZE)
+    chunk_size = math.ceil(len(msg) / num_of_packets)
+    return [msg[i:i+chunk_size] for i in range(0, len(msg), chunk_size)]
+
+
+class Span:
+    '''
+    A single sampled timing span.
+    Each stage is recorded as the number of seconds since the span began
+    '''
+    __slots__ = ('tracer', 'name', 'began', 'start', 'stages', 'info')
+
+    def __init__(self, tracer, name, info=None):
+        self.tracer = tracer
+        self.name = name
+        self.began = time.time()
+        self.start = time.perf_counter()
+        self.stages = []
+        self.info = info
+
+    def mark(self, stage):
+        '''
+        Records that the given stage was reached
+        '''
+        self.stages.append((stage, time.perf_counter() - self.start))
+
+    def as_dict(self):
+        '''
+        Returns the span as a JSON serialisable dictionary
+        '''
+        return {'name': self.name, 'time': self.began, 'info': self.info,
+                'stages': [[stage, round(offset * 1e6, 1)] for stage, offset in self.stages]}
+
+
+class Tracer:
+    '''
+    Collects sampled timing spans from the instrumentation hooks into a ring buffer.
+    sample_rate is the fraction of hook invocations that are timed
+    size is the number of spans kept, older spans are overwritten
+    '''
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, size=TRACE_BUFFER_SIZE):
+        self.sample_rate = sample_rate
+        self.spans = collections.deque(maxlen=size)
+
+    def begin(self, name, info=None):
+        '''
+        Returns a new span if this invocation is sampled, otherwise None
+        '''
+        if random.random() >= self.sample_rate:
+            return None
+        return Span(self, name, info)
+
+    def export(self, path=None):
+        '''
+        Returns the buffered spans, oldest first, and writes them to path as JSON lines if given
+        '''
+        spans = [span.as_dict() for span in list(self.spans)]
+        if path:
+            with open(path, 'w') as trace_file:
+                for span in spans:
+                    trace_file.write(json.dumps(span) + '\n')
+        return spans
+
+
+def enable_tracing(sample_rate=TRACE_SAMPLE_RATE, size=TRACE_BUFFER_SIZE):
+    '''
+    Installs a Tracer so that the instrumentation hooks start recording spans and returns it
+    '''
+    global TRACER
+    TRACER = Tracer(sample_rate, size)
+    return TRACER
+
+
+def disable_tracing():
+    '''
+    Removes the active Tracer, the hooks go back to doing nothing
+    '''
+    global TRACER
+    TRACER = None
+
+
+def trace_begin(name, info=None):
+    '''
+    Hook called at the start of an instrumented section.
+    Returns a Span when tracing is enabled and this call is sampled, otherwise None
+    '''
+    if TRACER is None:
+        return None
+    return TRACER.begin(name, info)
+
+
+def trace_end(span):
+    '''
+    Hook called at the end of an instrumented section, stores the span in its tracer's ring buffer
+    '''
+    if span is not None:
+        span.tracer.spans.append(span)
+
+
+class Message:
+    '''
+    An application message of the form `<message_type> <length> <body>`.
+    Only the type and length header are read when the message is parsed, the body is sliced out of the text when it is first used
+    '''
+    __slots__ = ('text', 'type', 'length', 'start', 'end', 'delivery')
+
+    def __init__(self, text, msg_type, length, start, end):
+        self.text = text
+        self.type = msg_type
+        self.length = length
+        self.start = start
+        self.end = end
+        # How the message reached us, see DELIVERY_RELIABLE and DELIVERY_DATAGRAM
+        self.delivery = DELIVERY_RELIABLE
+
+    @property
+    def body(self):
+        '''
+        The message body, everything after the length header
+        '''
+        return self.text[self.start:self.end]
+
+    def split_body(self, maxsplit=-1):
+        '''
+        Splits the body into words, at most maxsplit times so the rest of the body stays in one piece
+        '''
+        return self.text[self.start:self.end].split(None, maxsplit)
+
+
+def parse_message(text, pos=0):
+    '''
+    Reads the type and length header of the message starting at pos in text.
+    Returns a Message, or None if there is no message at pos
+    '''
+    text_len = len(text)
+    while pos < text_len and text[pos].isspace():
+        pos += 1
+    if pos >= text_len:
+        return None
+    type_end = text.find(' ', pos)
+    if type_end == -1:
+        return Message(text, text[pos:].rstrip(), 0, text_len, text_len)
+    length_end = text.find(' ', type_end + 1)
+    if length_end == -1:
+        length_end = text_len
+    length = text[type_end + 1:length_end]
+    start = min(length_end + 1, text_len)
+    # Messages from peers that do not send a valid length run to the end of the text
+    if length.isdigit():
+        length = int(length)
+        end = min(start + length, text_len)
+    else:
+        length = text_len - start
+        end = text_len
+    return Message(text, text[pos:type_end], length, start, end)
+
+
+def iter_messages(text):
+    '''
+    Yields every message in text. Queued messages are sent together in one transfer, one after another
+    '''
+    message = parse_message(text)
+    while message is not None:
+        yield message
+        message = parse_message(text, message.end)
+
+
 def handle_message(sock):
         '''
-        This function can be used to extract the message_type, format, and data from an incoming message from the socket
-        It will also return the address of the server that sent the message
-        message_type defines the type like join, disconnect etc.
-        length is the length of the message
-        data is everything after the length
+        This function can be used to extract the message from an incoming packet on the socket
+        It returns the message, parsed by parse_message(), and the address of the peer that sent it
+        The message is None if the packet did not carry one or was corrupted
         '''
         message, serveraddress = sock.recvfrom(4096)
+        span = trace_begin('handle_message')
+        if not verify_packet(message):
+            return None, serveraddress
         decoded_message = message.decode("utf-8")
         msg_type, seq_num, recv_msg, check_sum = parse_packet(decoded_message)
-        message_type = ''
-        message_length = ''
-        message_data = ''
-        if recv_msg:
-            parts = recv_msg.split()
-            if len(parts) >= 1:
-                message_type = parts[0]
-            if len(parts) >= 2:
-                message_length = parts[1]
-            if len(parts) >= 3:
-                message_data = parts[2:]
-        return message_type, message_length, message_data, serveraddress
+        if span:
+            span.mark('parse_packet')
+        message = parse_message(recv_msg)
+        if span:
+            span.mark('parse_message')
+            span.info = message.type if message else None
+            trace_end(span)
+        return message, serveraddress
+
+
+class TokenBucket:
+    '''
+    Allows `rate` units per second on average, in bursts of up to `burst` units.
+    The bucket is refilled lazily, when it is checked
+    '''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        '''
+        Adds the tokens earned since the last check, returns the tokens available
+        '''
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+
+class RateLimiter:
+    '''
+    The token buckets of one client, one for messages and one for bytes, a rate of 0 disables a bucket.
+    `limited` is set once a message is rejected and cleared when the buckets have refilled, so that the client is told once per episode
+    '''
+    def __init__(self, message_rate=RATE_LIMIT_MESSAGES, byte_rate=RATE_LIMIT_BYTES, burst=RATE_LIMIT_BURST):
+        self.messages = TokenBucket(message_rate, message_rate * burst) if message_rate > 0 else None
+        self.bytes = TokenBucket(byte_rate, byte_rate * burst) if byte_rate > 0 else None
+        self.limited = False
+
+    def admit(self, size):
+        '''
+        Takes the tokens for one message of `size` bytes, returns False without taking any if either bucket is short.
+        A message larger than the byte burst only needs a full bucket
+        '''
+        costs = [(self.messages, 1), (self.bytes, size)]
+        full = True
+        for bucket, cost in costs:
+            if bucket is not None:
+                tokens = bucket.refill()
+                if tokens < min(cost, bucket.capacity):
+                    self.limited = True
+                    return False
+                full = full and tokens == bucket.capacity
+        for bucket, cost in costs:
+            if bucket is not None:
+                bucket.tokens -= min(cost, bucket.capacity)
+        if full:
+            self.limited = False
+        return True
+
+    def charge(self, size):
+        '''
+        Takes `size` bytes from the byte bucket for data that is not refused, such as the chunks of a relayed file.
+        The bucket may go below empty, the client then has to wait for it to refill before it can send more
+        '''
+        if self.bytes is not None:
+            self.bytes.refill()
+            self.bytes.tokens -= size
+
+    def has_bytes(self):
+        '''
+        Returns whether the byte bucket has tokens left
+        '''
+        return self.bytes is None or self.bytes.refill() > 0
+
+    def full(self):
+        '''
+        Returns whether both buckets have refilled, the limiter then holds nothing a new one would not
+        '''
+        return all(bucket is None or bucket.refill() >= bucket.capacity for bucket in (self.messages, self.bytes))
+
+
+class SendQueue:
+    '''
+    The messages waiting to be sent to one peer, in priority classes.
+    Items are taken from the highest class that has credit left in the current round, every class gets PRIORITY_WEIGHTS credit per round,
+    so a busy higher class delays the lower ones but never starves them. Items of one class keep their order.
+    Raises queue.Full and queue.Empty like queue.Queue
+    '''
+    def __init__(self, maxsize=SEND_QUEUE_SIZE, weights=PRIORITY_WEIGHTS):
+        self.maxsize = maxsize
+        self.weights = weights
+        self.classes = [collections.deque() for _ in weights]
+        self.credits = list(weights)
+        self.size = 0
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+
+    def qsize(self):
+        '''
+        Returns the number of queued items
+        '''
+        return self.size
+
+    def empty(self):
+        '''
+        Returns whether nothing is queued
+        '''
+        return self.size == 0
+
+    def put(self, item, priority=PRIORITY_CONTROL, block=True, timeout=None):
+        '''
+        Queues an item in its priority class, waiting up to timeout for room if block is set.
+        Raises queue.Full if maxsize items are still queued
+        '''
+        with self.not_full:
+            if block and self.maxsize > 0 and not self.not_full.wait_for(lambda: self.size < self.maxsize, timeout):
+                raise queue.Full
+            if 0 < self.maxsize <= self.size:
+                raise queue.Full
+            self.classes[priority].append(item)
+            self.size += 1
+            self.not_empty.notify()
+
+    def put_nowait(self, item, priority=PRIORITY_CONTROL):
+        '''
+        Queues an item in its priority class without waiting
+        '''
+        self.put(item, priority, False)
+
+    def requeue(self, item, priority):
+        '''
+        Puts an item that was taken back at the front of its class, whether the queue is full or not
+        '''
+        with self.not_empty:
+            self.classes[priority].appendleft(item)
+            self.size += 1
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        '''
+        Takes the next item, waiting up to timeout for one if block is set
+        '''
+        with self.not_empty:
+            if block and not self.not_empty.wait_for(lambda: self.size, timeout):
+                raise queue.Empty
+            if not self.size:
+                raise queue.Empty
+            # Start a new round once every class with items has used up its credit
+            if not any(items and credit > 0 for items, credit in zip(self.classes, self.credits)):
+                self.credits = list(self.weights)
+            for priority, items in enumerate(self.classes):
+                if items and self.credits[priority] > 0:
+                    self.credits[priority] -= 1
+                    self.size -= 1
+                    self.not_full.notify()
+                    return items.popleft()
+
+    def get_nowait(self):
+        '''
+        Takes the next item without waiting
+        '''
+        return self.get(False)
+
+    def push(self, item, priority):
+        '''
+        Puts an item at the back of its class, whether the queue is full or not
+        '''
+        with self.not_empty:
+            self.classes[priority].append(item)
+            self.size += 1
+            self.not_empty.notify()
+
+    def drop(self):
+        '''
+        Removes the oldest message of the lowest class that has any, raises queue.Empty if there is none.
+        Streams are never dropped, their uploader waits for them to be sent
+        '''
+        with self.not_empty:
+            for items in reversed(self.classes):
+                for item in items:
+                    if isinstance(item, str):
+                        items.remove(item)
+                        self.size -= 1
+                        self.not_full.notify()
+                        return item
+            raise queue.Empty
+
+
+class CongestionWindow:
+    '''
+    AIMD congestion window for one peer, counted in packets.
+    It grows by one packet per ACKed packet during slow start and by one packet per round trip once it reaches ssthresh.
+    A timeout drops it back to one packet, duplicate ACKs halve it.
+    limit caps the window so that it can not grow without bound while the path is never congested
+    '''
+    def __init__(self, limit=MAX_CWND, ssthresh=INITIAL_SSTHRESH):
+        self.limit = limit
+        self.cwnd = 1.0
+        self.ssthresh = ssthresh
+
+    def size(self):
+        '''
+        Returns the number of packets that may be in flight
+        '''
+        return int(self.cwnd)
+
+    def on_ack(self, packets):
+        '''
+        Grows the window for the given number of newly acknowledged packets
+        '''
+        for _ in range(packets):
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.limit)
+
+    def on_timeout(self):
+        '''
+        Multiplicative decrease after a retransmission timeout, restarting from slow start
+        '''
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = 1.0
+
+    def on_duplicate_acks(self):
+        '''
+        Multiplicative decrease after a fast retransmit, the window continues from the halved size
+        '''
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = min(self.ssthresh, self.limit)
+
+
+class ReliableSender:
+    '''
+    Sends messages to one peer using the START/DATA/END exchange.
+    The number of DATA packets in flight is limited by window, by the window the peer advertises in its ACKs and by the congestion window.
+    ACKs are cumulative. After a timeout everything unacknowledged is sent again and the timeout doubles,
+    DUP_ACK_THRESHOLD duplicate ACKs trigger a fast retransmit of the first missing packet.
+    ACKs must be passed in through on_ack() by whichever thread reads the socket.
+    A peer that answers the START of a stream with an offset already holds that many chunks, the stream resumes after them
+    '''
+    def __init__(self, sock, address, window=3):
+        self.sock = sock
+        self.address = address
+        self.window = int(window)
+        self.peer_window = self.window
+        self.congestion = CongestionWindow()
+        self.time_out = TIME_OUT
+        self.acked = -1
+        self.sent_upto = -1
+        self.duplicate_acks = 0
+        self.acks_received = 0
+        self.window_opened = False
+        self.resume_offset = 0
+        self.rebound = False
+        self.cancelled = False
+        # When a transfer last started or an ACK last moved forward, so that a peer that stopped taking what we send
+        # can be told from a slow one
+        self.last_progress = time.monotonic()
+        self.ack_event = threading.Condition()
+
+    def on_ack(self, seq_num, window=None, offset=0):
+        '''
+        Records an ACK from the peer. ACKs outside the packets sent in the current transfer are ignored
+        '''
+        with self.ack_event:
+            if self.acked <= seq_num <= self.sent_upto:
+                self.acks_received += 1
+                if offset:
+                    self.resume_offset = offset
+                if seq_num > self.acked:
+                    self.last_progress = time.monotonic()
+                    self.congestion.on_ack(seq_num - self.acked)
+                    self.duplicate_acks = 0
+                elif window != 0:
+                    self.duplicate_acks += 1
+                self.acked = seq_num
+                if window is not None:
+                    if self.peer_window == 0 and window > 0:
+                        self.window_opened = True
+                    self.peer_window = window
+                self.ack_event.notify()
+
+    def rebind(self, address):
+        '''
+        Sends to the peer at its new address from now on, the transfer in progress is started over there
+        '''
+        with self.ack_event:
+            self.address = address
+            self.rebound = True
+            self.ack_event.notify()
+
+    def cancel(self):
+        '''
+        Gives up the transfer in progress, the peer refused it
+        '''
+        with self.ack_event:
+            self.cancelled = True
+            self.ack_event.notify()
+
+    def transmit(self, msg_type, seq_num, chunk=""):
+        '''
+        Sends a single packet to the peer
+        '''
+        self.sock.sendto(encode_packet(msg_type, seq_num, chunk), self.address)
+
+    def wait_for_ack(self, seq_num):
+        '''
+        Waits until the cumulative ACK moves past seq_num, DUP_ACK_THRESHOLD duplicate ACKs arrive,
+        a zero window opens up again, the peer moves to a new address, the transfer is cancelled or the timeout expires.
+        Returns the latest ACK number
+        '''
+        deadline = time.monotonic() + self.time_out
+        with self.ack_event:
+            while (self.acked <= seq_num and self.duplicate_acks < DUP_ACK_THRESHOLD and not self.window_opened
+                   and not self.rebound and not self.cancelled):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.ack_event.wait(remaining)
+            return self.acked
+
+    def on_timeout(self):
+        '''
+        Backs off after a retransmission timeout
+        '''
+        with self.ack_event:
+            self.congestion.on_timeout()
+            self.duplicate_acks = 0
+        self.time_out = min(self.time_out * 2, MAX_TIME_OUT)
+
+    def send_control(self, msg_type, seq_num, header=""):
+        '''
+        Sends a START or END packet until it is acknowledged, returns False if the peer never answers
+        '''
+        with self.ack_event:
+            self.sent_upto = seq_num + 1
+        for _ in range(MAX_RETRIES + 1):
+            # A window opening up means nothing to a START or END, it would only cut the wait for its ACK short
+            with self.ack_event:
+                self.window_opened = False
+            self.transmit(msg_type, seq_num, header)
+            if self.wait_for_ack(seq_num) > seq_num:
+                self.time_out = TIME_OUT
+                return True
+            if self.rebound or self.cancelled:
+                return False
+            self.on_timeout()
+        return False
+
+    def send(self, chunks, header=""):
+        '''
+        Reliably sends chunks, any iterable of strings, as a single transfer.
+        Chunks are only pulled from the iterable once they fit in the window, so streams are never held in memory as a whole.
+        A header is carried by the START packet and makes the peer treat the transfer as a stream, see ReliableReceiver
+        A list of chunks is sent again from the start if the peer moves to a new address during the transfer, a stream is not
+        Returns True once the END packet is acknowledged, or False if the peer stopped responding
+        '''
+        while True:
+            sent = self.transfer(chunks, header)
+            if sent or not self.rebound or not isinstance(chunks, list):
+                return sent
+
+    def transfer(self, chunks, header=""):
+        '''
+        Makes a single attempt of send(), returns False as soon as the peer moves to a new address
+        '''
+        span = trace_begin('send_reliable_message')
+        # The first transfer starts at a random sequence number, later ones continue after the previous one,
+        # so the packets of transfers the peer remembers as completed never look like those of a new one
+        start_seq_num = self.sent_upto + 1 if self.sent_upto >= 0 else random.randint(1, 1000000)
+        with self.ack_event:
+            self.acked = start_seq_num
+            self.duplicate_acks = 0
+            self.resume_offset = 0
+            self.rebound = False
+            self.cancelled = False
+            self.last_progress = time.monotonic()
+        if not self.send_control('start', start_seq_num, header):
+            return False
+        if span:
+            span.mark('start_acked')
+
+        # A stream continues where the peer tells it to, also at the start when it holds none of it
+        if header and not isinstance(chunks, list):
+            chunks.resume(self.resume_offset)
+        chunks = iter(chunks)
+        unacked = collections.OrderedDict()
+        # next_seq_num is the next packet to transmit, it moves back to the first unacknowledged packet after a timeout
+        next_seq_num = start_seq_num + 1
+        # The chunk after the ones sent so far is pulled early, so that the END can follow the last DATA packet right away
+        lookahead = None
+        exhausted = False
+        end_seq = None
+        probe = False
+        retries = 0
+        while True:
+            with self.ack_event:
+                base = self.acked
+                limit = min(self.window, self.peer_window, self.congestion.size())
+                fast_retransmit = self.duplicate_acks >= DUP_ACK_THRESHOLD
+                if fast_retransmit:
+                    self.congestion.on_duplicate_acks()
+                    self.duplicate_acks = 0
+            # Forget the packets the peer has acknowledged
+            while unacked and next(iter(unacked)) < base:
+                unacked.popitem(last=False)
+            next_seq_num = max(next_seq_num, base)
+            if fast_retransmit and base in unacked:
+                self.transmit('data', base, unacked[base])
+            # Fill the window, the peer advertising a zero window still gets a single probe
+            if probe:
+                limit = max(limit, 1)
+                probe = False
+            while next_seq_num - base < limit:
+                if next_seq_num in unacked:
+                    chunk = unacked[next_seq_num]
+                elif exhausted:
+                    break
+                else:
+                    chunk = next(chunks, None) if lookahead is None else lookahead
+                    lookahead = None
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    unacked[next_seq_num] = chunk
+                    with self.ack_event:
+                        self.sent_upto = next_seq_num + 1
+                self.transmit('data', next_seq_num, chunk)
+                next_seq_num += 1
+            if not exhausted and lookahead is None:
+                lookahead = next(chunks, None)
+                exhausted = lookahead is None
+            if exhausted and not unacked:
+                break
+            # Once every DATA packet went out, the END asks the peer to acknowledge them all without delaying its ACK
+            if exhausted and end_seq is None and next_seq_num == self.sent_upto:
+                end_seq = next_seq_num
+                with self.ack_event:
+                    self.sent_upto = end_seq + 1
+                self.transmit('end', end_seq)
+            acks_received = self.acks_received
+            if self.wait_for_ack(base) > base:
+                retries = 0
+                self.time_out = TIME_OUT
+                continue
+            with self.ack_event:
+                if self.rebound or self.cancelled:
+                    return False
+                if self.duplicate_acks >= DUP_ACK_THRESHOLD:
+                    continue
+                # Packets the peer refused while its window was closed have to be sent again
+                if self.window_opened:
+                    self.window_opened = False
+                    retries = 0
+                    next_seq_num = base
+                    continue
+                # A peer that answers the probes with a zero window is busy, not gone
+                if self.peer_window == 0 and self.acks_received != acks_received:
+                    retries = 0
+                    probe = True
+                    next_seq_num = base
+                    continue
+            # Timed out, go back to the first unacknowledged packet
+            retries += 1
+            if retries > MAX_RETRIES:
+                return False
+            self.on_timeout()
+            # A closed window still gets one packet, its ACK tells whether the window has opened up again
+            probe = True
+            next_seq_num = base
+        if span:
+            span.mark('data_acked')
+
+        if end_seq is None:
+            end_seq = next_seq_num
+        if self.acked <= end_seq and not self.send_control('end', end_seq):
+            return False
+        if span:
+            span.mark('transfer_complete')
+            trace_end(span)
+        return True
+
+
+class ReliableReceiver:
+    '''
+    Reassembles the transfers sent to us by one peer.
+    DATA packets within the window are buffered even if they arrive out of order.
+    Every packet is answered with a cumulative ACK that advertises the space left in the window.
+    A START packet that carries a header begins a stream: open_stream(header) returns a sink with write(chunk), space() and close(complete),
+    or None to discard the stream. Chunks are written to the sink as soon as they are in order instead of being reassembled,
+    and the sink's free space limits the advertised window.
+    A sink can be one a stream was written to before it was interrupted, resume_offset is then the number of chunks it already holds.
+    The last COMPLETED_TRANSFERS transfers are remembered for COMPLETED_TIME_OUT, so that their packets arriving again
+    are acknowledged without being delivered a second time.
+    DATA packets that arrive in order are acknowledged ACK_EVERY at a time: on_packet() then returns None as the ACK number
+    and the owner sends the ACK from delayed_ack() once ack_deadline has passed, unless the next packet came first.
+    START, END, the first DATA packet of a transfer, anything out of order and the last packet the advertised window allowed
+    are acknowledged immediately
+    '''
+    def __init__(self, window=3, open_stream=None):
+        self.window = int(window)
+        self.open_stream = open_stream
+        self.resume_offset = 0
+        self.start_seq = None
+        self.expected = None
+        self.chunks = []
+        self.out_of_order = {}
+        self.streaming = False
+        self.stream = None
+        self.completed = collections.OrderedDict()
+        self.delayed_packets = 0
+        self.ack_deadline = None
+        self.ack_limit = 0
+
+    def completed_ack(self, seq_num):
+        '''
+        Returns the ACK for a packet of a recently completed transfer, or None if it is not part of one
+        '''
+        now = time.monotonic()
+        while self.completed and now - next(iter(self.completed.values()))[1] > COMPLETED_TIME_OUT:
+            self.completed.popitem(last=False)
+        for start_seq, (end_seq, _) in self.completed.items():
+            if start_seq <= seq_num <= end_seq:
+                self.completed[start_seq] = (end_seq, now)
+                self.completed.move_to_end(start_seq)
+                return end_seq + 1
+        return None
+
+    def ack_now(self):
+        '''
+        Returns the ACK number of the transfer in progress and cancels the delayed ACK it covers
+        '''
+        self.delayed_packets = 0
+        self.ack_deadline = None
+        # The sender may send up to, but not including, ack_limit before it needs the next ACK
+        if self.expected is not None:
+            self.ack_limit = self.expected + self.advertised_window()
+        return self.expected
+
+    def delayed_ack(self):
+        '''
+        Returns the ACK number to send once ack_deadline has passed, or None if there is nothing to acknowledge any more
+        '''
+        if self.ack_deadline is None or self.ack_deadline > time.monotonic():
+            return None
+        return self.ack_now()
+
+    def advertised_window(self):
+        '''
+        Returns the number of DATA packets the sender may still have in flight
+        '''
+        window = self.window - len(self.out_of_order)
+        if self.stream is not None:
+            window = max(0, min(window, self.stream.space()))
+        return window
+
+    def accept(self, data):
+        '''
+        Takes the next in order DATA chunk, returns False if a stream sink has no space for it
+        '''
+        if not self.streaming:
+            self.chunks.append(data)
+        elif self.stream is not None:
+            if self.stream.space() <= 0:
+                return False
+            self.stream.write(data)
+        return True
+
+    def on_packet(self, msg_type, seq_num, data):
+        '''
+        Processes a START, DATA or END packet.
+        Returns the ACK number to send back, or None if the ACK is delayed,
+        and the reassembled message once the END packet arrives, otherwise None
+        '''
+        if msg_type == 'start':
+            if seq_num == self.start_seq and self.expected is not None:
+                # Retransmitted START of the transfer in progress
+                return self.expected, None
+            if seq_num in self.completed:
+                # START of a transfer that already completed, arriving late
+                return self.completed_ack(seq_num), None
+            # Initialize a new message reception, a stream cut short by it is incomplete and may be resumed later
+            if self.stream is not None:
+                self.stream.close(False)
+            self.start_seq = seq_num
+            self.expected = seq_num + 1
+            self.chunks = []
+            self.out_of_order = {}
+            self.streaming = bool(data)
+            self.stream = self.open_stream(data) if data and self.open_stream else None
+            self.resume_offset = self.stream.received if self.stream is not None else 0
+            # The first DATA packet is acknowledged right away, the sender may have nothing more to send
+            self.ack_now()
+            self.delayed_packets = ACK_EVERY - 1
+            return self.expected, None
+
+        if self.expected is None:
+            # The sender missed the ACK for the END of a completed transfer and sent it again
+            ack_num = self.completed_ack(seq_num)
+            if ack_num is not None:
+                return ack_num, None
+            # Nothing is being received, acknowledge so the sender can move on
+            return (seq_num + 1 if msg_type == 'data' else seq_num), None
+
+        if msg_type == 'data':
+            in_order = False
+            if seq_num == self.expected:
+                in_order = not self.out_of_order
+                if self.accept(data):
+                    self.expected += 1
+                else:
+                    in_order = False
+                # Deliver the buffered packets that are now in order
+                while self.expected in self.out_of_order and self.accept(self.out_of_order[self.expected]):
+                    del self.out_of_order[self.expected]
+                    self.expected += 1
+            elif self.expected < seq_num < self.expected + self.window:
+                self.out_of_order[seq_num] = data
+            # A sender that used up the window we advertised is waiting for this ACK, so it is not delayed
+            if in_order and self.delayed_packets < ACK_EVERY - 1 and self.expected < self.ack_limit:
+                self.delayed_packets += 1
+                if self.ack_deadline is None:
+                    self.ack_deadline = time.monotonic() + ACK_DELAY
+                return None, None
+            # Gaps, duplicates and refused packets are acknowledged immediately so the sender notices them
+            return self.ack_now(), None
+
+        if msg_type == 'end' and seq_num == self.expected:
+            # All packets received, combine the chunks
+            message = None if self.streaming else ''.join(self.chunks)
+            if self.stream is not None:
+                self.stream.close(True)
+            self.completed[self.start_seq] = (seq_num, time.monotonic())
+            if len(self.completed) > COMPLETED_TRANSFERS:
+                self.completed.popitem(last=False)
+            self.ack_now()
+            self.expected = None
+            self.chunks = []
+            self.stream = None
+            return seq_num + 1, message
+
+        return self.expected, None
+
+
+class LocalSender:
+    '''
+    Sends to a peer on the same host over a Unix datagram socket, with the same send() as ReliableSender.
+    The socket is reliable and ordered and blocks while the peer's queue is full, so nothing is numbered, checksummed,
+    acknowledged or retransmitted. A message that fits in one datagram is sent as `msg|<text>`,
+    anything else as `start|<header>`, then `data|<chunk>` for every chunk and `end|`
+    '''
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        # Cleared while the peer holds back what we sent, see LocalReceiver
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.cancelled = False
+        # When the peer last took a datagram, the socket blocks while it takes none
+        self.last_progress = time.monotonic()
+
+    def rebind(self, address):
+        '''
+        Sends to the peer at its new address from now on
+        '''
+        self.address = address
+
+    def hold(self, held):
+        '''
+        Pauses sending while the peer holds back what we sent, or resumes it
+        '''
+        if held:
+            self.resumed.clear()
+        else:
+            self.resumed.set()
+
+    def cancel(self):
+        '''
+        Gives up the stream in progress, the peer refused it
+        '''
+        self.cancelled = True
+        self.resumed.set()
+
+    def send(self, chunks, header=""):
+        '''
+        Sends chunks, any iterable of strings, as a single transfer, a header makes the peer treat it as a stream.
+        A paused sender waits before each chunk, for RELAY_TIME_OUT at most in case the peer's word to resume was lost.
+        Returns False if the peer is gone or the stream was cancelled
+        '''
+        self.cancelled = False
+        try:
+            if not header and isinstance(chunks, list):
+                datagram = ('msg|' + ''.join(chunks)).encode('utf-8')
+                if len(datagram) <= LOCAL_DATAGRAM_SIZE:
+                    self.resumed.wait(RELAY_TIME_OUT)
+                    self.sock.sendto(datagram, self.address)
+                    self.last_progress = time.monotonic()
+                    return True
+            self.resumed.wait(RELAY_TIME_OUT)
+            self.sock.sendto(('start|' + header).encode('utf-8'), self.address)
+            for chunk in chunks:
+                self.resumed.wait(RELAY_TIME_OUT)
+                if self.cancelled:
+                    return False
+                self.sock.sendto(('data|' + chunk).encode('utf-8'), self.address)
+                self.last_progress = time.monotonic()
+            self.sock.sendto(b'end|', self.address)
+            self.last_progress = time.monotonic()
+            return True
+        except OSError:
+            return False
+
+
+class LocalReceiver:
+    '''
+    Receives the transfers a LocalSender sends us.
+    Streams go to the sink open_stream(header) returns, as with ReliableReceiver. Once the sink is full, the datagrams that follow
+    are held back, in order, until drain() finds space for them, so the thread reading the socket never waits for a sink.
+    on_hold(True) is called when the receiver starts holding back and on_hold(False) once it caught up, so that the peer
+    can be told to pause, the sender passed in is paused and resumed when the peer tells us so with `wait|` and `go|`.
+    With resume_streams set, a sink that already holds chunks from an interrupted transfer skips that many,
+    since the sender can not be told where to resume
+    '''
+    def __init__(self, open_stream=None, resume_streams=False, on_hold=None, sender=None):
+        self.open_stream = open_stream
+        self.resume_streams = resume_streams
+        self.on_hold = on_hold
+        self.sender = sender
+        self.chunks = []
+        self.streaming = False
+        self.stream = None
+        self.skip = 0
+        self.held = collections.deque()
+        # Nothing is acknowledged, so no ACK is ever delayed
+        self.ack_deadline = None
+
+    def blocked(self, datagram):
+        '''
+        Returns whether a datagram is a chunk the stream sink has no space for
+        '''
+        return (datagram.startswith(b'data|') and self.streaming and not self.skip and self.stream is not None
+                and self.stream.space() <= 0 and not getattr(self.stream, 'finished', False))
+
+    def on_datagram(self, datagram):
+        '''
+        Processes one datagram, returns the message once it is complete, otherwise None
+        '''
+        if not self.held and not self.blocked(datagram):
+            return self.process(datagram)
+        self.held.append(datagram)
+        if len(self.held) == 1 and self.on_hold is not None:
+            self.on_hold(True)
+        return None
+
+    def drain(self):
+        '''
+        Processes the held back datagrams the stream sink has space for now, returns the messages they complete
+        '''
+        messages = []
+        if not self.held:
+            return messages
+        while self.held and not self.blocked(self.held[0]):
+            message = self.process(self.held.popleft())
+            if message is not None:
+                messages.append(message)
+        if not self.held and self.on_hold is not None:
+            self.on_hold(False)
+        return messages
+
+    def process(self, datagram):
+        '''
+        Processes one datagram in order, returns the message once it is complete, otherwise None
+        '''
+        kind, _, data = datagram.decode('utf-8').partition('|')
+        if kind == 'msg':
+            return data
+        if kind in ('wait', 'go'):
+            if self.sender is not None:
+                self.sender.hold(kind == 'wait')
+            return None
+        if kind == 'start':
+            # A stream cut short by a new transfer is incomplete
+            if self.stream is not None:
+                self.stream.close(False)
+            self.chunks = []
+            self.streaming = bool(data)
+            self.stream = self.open_stream(data) if data and self.open_stream else None
+            self.skip = self.stream.received if self.stream is not None and self.resume_streams else 0
+        elif kind == 'data':
+            if not self.streaming:
+                self.chunks.append(data)
+            elif self.skip:
+                self.skip -= 1
+            elif self.stream is not None:
+                self.stream.write(data)
+        elif kind == 'end':
+            message = None if self.streaming else ''.join(self.chunks)
+            if self.stream is not None:
+                self.stream.close(True)
+            self.chunks = []
+            self.stream = None
+            return message
+        return None
+
+
+class FileStream:
+    '''
+    Source for sending a file as a stream.
+    The file is read incrementally through a memory map and each chunk is base64 encoded so it can travel in a packet
+    '''
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.offset = 0
+
+    def resume(self, offset):
+        '''
+        Skips the first offset chunks, which the peer already received
+        '''
+        self.offset = offset
+
+    def __iter__(self):
+        with open(self.path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size <= self.offset * FILE_CHUNK_SIZE:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(self.offset * FILE_CHUNK_SIZE, size, FILE_CHUNK_SIZE):
+                    yield base64.b64encode(mapped[offset:offset + FILE_CHUNK_SIZE]).decode('ascii')
+
+
+class FileDownload:
+    '''
+    Sink that writes a received file stream straight to disk, on_close(download) is called once the stream ends.
+    With the expected size given, a file can arrive in several transfers: it stays open until that many bytes arrived
+    or abort() is called, a transfer of it that is cut short may be resumed.
+    With resume set, the whole chunks already in the file at path are kept and the stream goes on after them
+    '''
+    def __init__(self, path, on_close=None, expected_size=None, resume=False):
+        self.path = path
+        self.on_close = on_close
+        self.expected_size = expected_size
+        self.received = os.path.getsize(path) // FILE_CHUNK_SIZE if resume and os.path.isfile(path) else 0
+        self.size = self.received * FILE_CHUNK_SIZE
+        if self.received:
+            os.truncate(path, self.size)
+            self.file = open(path, 'ab')
+        else:
+            self.file = open(path, 'wb')
+        self.complete = False
+        self.closed = False
+
+    def space(self):
+        '''
+        Writes go straight to the file, so there is always space
+        '''
+        return sys.maxsize
+
+    def write(self, chunk):
+        '''
+        Decodes a chunk and appends it to the file
+        '''
+        data = base64.b64decode(chunk)
+        self.file.write(data)
+        self.size += len(data)
+        self.received += 1
+
+    def close(self, complete):
+        '''
+        Closes the file, complete tells whether the whole stream arrived.
+        A file of expected size stays open until all of it arrived, what arrived so far is written out
+        '''
+        if self.closed:
+            return
+        if self.expected_size is not None and self.size < self.expected_size:
+            self.file.flush()
+            return
+        self.finish(complete)
+
+    def abort(self):
+        '''
+        Closes the file as incomplete, the sender stopped before all of it arrived
+        '''
+        if not self.closed:
+            self.finish(False)
+
+    def finish(self, complete):
+        '''
+        Closes the file and tells on_close
+        '''
+        self.file.close()
+        self.closed = True
+        self.complete = complete
+        if self.on_close is not None:
+            self.on_close(self)
+
+
+class RelayStream:
+    '''
+    Sink on one side and source on the other, used to pass a stream from one peer on to another chunk by chunk.
+    At most RELAY_BUFFER chunks are held, a full relay makes the incoming side advertise a zero window
+    and on_space() is called once it has drained to half, so that the incoming side can announce the window opening up.
+    If the outgoing side stops taking chunks for RELAY_TIME_OUT the relay is abandoned and further chunks are discarded.
+    An incoming stream that is cut short keeps the relay open for RELAY_TIME_OUT, so that its sender can resume it after the chunks already received.
+    A relay created without a header is pending: it takes no chunks until start() gives it one or abandon() discards it,
+    reject() discards it while the window stays closed.
+    The chunks written are charged to limiter, the RateLimiter of the incoming side if it has one, and no chunks are taken while it has no bytes left
+    '''
+    def __init__(self, header, on_space=None):
+        self.header = header
+        self.on_space = on_space
+        self.pending = header is None
+        self.chunks = queue.Queue(RELAY_BUFFER)
+        # Chunks of a segment that was cut short, they are taken again before the queued ones
+        self.returned = collections.deque()
+        self.received = 0
+        self.taken = 0
+        self.segments = 0
+        self.finished = False
+        self.closed = False
+        self.abandoned = False
+        self.stalled = False
+        self.last_chunk = None
+        self.last_taken = time.monotonic()
+        self.limiter = None
+
+    def space(self):
+        '''
+        Returns the number of chunks the relay can take
+        '''
+        if self.pending or self.limiter is not None and not self.limiter.has_bytes():
+            return 0
+        free = RELAY_BUFFER - self.chunks.qsize()
+        if free <= 0:
+            self.stalled = True
+            if time.monotonic() - self.last_taken > RELAY_TIME_OUT:
+                self.abandoned = True
+        return RELAY_BUFFER if self.abandoned else free
+
+    def write(self, chunk):
+        '''
+        Queues a chunk for the outgoing side
+        '''
+        if self.limiter is not None:
+            self.limiter.charge(len(chunk))
+        if not self.abandoned:
+            self.chunks.put_nowait(chunk)
+        self.received += 1
+
+    def start(self, header):
+        '''
+        Gives a pending relay its header, it takes chunks from now on
+        '''
+        self.header = header
+        self.last_taken = time.monotonic()
+        self.pending = False
+        if self.on_space is not None:
+            self.on_space()
+
+    def reject(self):
+        '''
+        Discards a pending stream without opening its window, the incoming side is told to stop instead
+        '''
+        self.abandoned = True
+        self.finished = True
+
+    def abandon(self):
+        '''
+        Discards the stream, the chunks that arrive from now on are dropped
+        '''
+        self.abandoned = True
+        self.finished = True
+        self.pending = False
+        if self.on_space is not None:
+            self.on_space()
+
+    def close(self, complete):
+        '''
+        Marks the incoming stream as finished, the outgoing side ends once it has taken the queued chunks
+        An incomplete stream may still be resumed, it ends once it has not delivered a chunk for RELAY_TIME_OUT
+        '''
+        if complete:
+            self.closed = True
+
+    def take(self):
+        '''
+        Returns the next chunk for the outgoing side, or None if there is none within TIME_OUT.
+        The relay is finished once the incoming stream is closed and drained, or has not delivered a chunk for RELAY_TIME_OUT
+        '''
+        if self.last_chunk is None:
+            self.last_chunk = time.monotonic()
+        if self.abandoned:
+            self.finished = True
+            return None
+        if self.returned:
+            self.taken += 1
+            return self.returned.popleft()
+        try:
+            # Nothing is written after the incoming stream closed
+            chunk = self.chunks.get(not self.closed, TIME_OUT)
+        except queue.Empty:
+            if self.closed or time.monotonic() - self.last_chunk > RELAY_TIME_OUT:
+                self.finished = True
+            return None
+        self.last_chunk = self.last_taken = time.monotonic()
+        self.taken += 1
+        if self.stalled and self.chunks.qsize() <= RELAY_BUFFER // 2:
+            self.stalled = False
+            if self.on_space is not None:
+                self.on_space()
+        return chunk
+
+    def segment(self, size=RELAY_SEGMENT):
+        '''
+        Returns the RelaySegment to send as the next transfer of the relay, up to size chunks and fewer if the incoming side pauses.
+        Returns None if no chunk arrived within TIME_OUT or the relay is finished, a relay that finishes without any chunk is sent once, empty
+        '''
+        first = self.take()
+        if first is None:
+            if self.finished and self.segments == 0:
+                self.segments += 1
+                return []
+            return None
+        self.segments += 1
+        return RelaySegment(self, first, size)
+
+    def unread(self, segment):
+        '''
+        Puts back the chunks a segment took that its peer may not have, the transfer of the segment was cut short
+        '''
+        chunks = ([segment.first] if segment.first is not None else []) + segment.sent
+        self.returned.extendleft(reversed(chunks))
+        self.taken -= len(chunks)
+
+    def __iter__(self):
+        # Ends when the relay is finished
+        while not self.finished:
+            chunk = self.take()
+            if chunk is not None:
+                yield chunk
+
+
+class RelaySegment:
+    '''
+    The chunks of a RelayStream sent as one transfer, see RelayStream.segment().
+    The peer answering the START with an offset already holds that many chunks of the stream, resume() skips the ones
+    among them. The chunks sent are kept until the transfer ends, so that a transfer cut short can put them back with RelayStream.unread()
+    '''
+    def __init__(self, relay, first, size):
+        self.relay = relay
+        self.first = first
+        self.size = size
+        # Position of the first chunk in the stream
+        self.start = relay.taken - 1
+        self.pulled = 0
+        self.sent = []
+        # Set when the peer holds fewer chunks than were sent to it before, the chunks in between are gone
+        self.gap = False
+
+    def pull(self):
+        '''
+        Returns the next chunk of the segment, or None once it has size chunks or the relay pauses
+        '''
+        if self.pulled >= self.size:
+            return None
+        if self.first is not None:
+            chunk, self.first = self.first, None
+        else:
+            chunk = self.relay.take()
+        if chunk is not None:
+            self.pulled += 1
+        return chunk
+
+    def resume(self, offset):
+        '''
+        Skips the chunks the peer already holds, offset counts them from the start of the stream
+        '''
+        if offset < self.start:
+            self.gap = True
+            return
+        for _ in range(offset - self.start):
+            if self.pull() is None:
+                return
+
+    def __iter__(self):
+        if self.gap:
+            return
+        while True:
+            chunk = self.pull()
+            if chunk is None:
+                return
+            self.sent.append(chunk)
+            yield chunk